@@ -6,23 +6,63 @@ import argparse
 import yaml
 from datetime import datetime
 import igraph as ig
+import scipy.sparse as sp
 from tqdm import tqdm
 import logging
+import perf_log
+from id_dict import load_id_dict, trans_codes
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-ch = logging.FileHandler('.netlogfile', 'w')
+ch = logging.FileHandler('.netlogfile', 'a')
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
+def network_fname(bank, fname_prefix=None):
+    '''
+    merchant network path, subsets created by derive_subset.py have their own prefixed network
+    '''
+    fname = f'filtered_bank_{bank}.pickle'
+    if fname_prefix and exists(join('data', 'networks', f'{fname_prefix}_{fname}')):
+        fname = f'{fname_prefix}_{fname}'
+    return join('data', 'networks', fname)
+
+
+def network_id_dict(bank, fname_prefix=None):
+    '''
+    id dictionary of the network picked by network_fname, vertex indices are codes of this
+    dictionary. a master network is always decoded with the master dictionary, even if a
+    prefixed dictionary (e.g. of filter_records.py --prefix) exists.
+    '''
+    if network_fname(bank, fname_prefix) == network_fname(bank):
+        return load_id_dict(bank)
+    return load_id_dict(bank, fname_prefix)
+
+
+def temporal_fname(bank, window, fname_prefix=None):
+    '''
+    temporal networks path, None if a prefix is given and there are no prefixed temporal networks
+    '''
+    fname = f'temporal_bank_{bank}_w{window}.npz'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+        if not exists(join('data', 'networks', fname)):
+            return None
+    return join('data', 'networks', fname)
+
+
+@perf_log.stage('const_trans_net')
 def const_trans_net(config, bank, overwrite=False):
     '''
     construct merchant networks from transaction records
     '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
     output_file = join('data', 'networks', f'filtered_bank_{bank}.pickle')
     if exists(output_file):
         if not overwrite:
@@ -36,7 +76,10 @@ def const_trans_net(config, bank, overwrite=False):
     trans_cols = config['tran_cols'][f'bank_{bank}']
 
     # trans_df = pd.read_csv(join('data', f'bank_{bank}_transactions.csv'), dtype={trans_cols['merchant_id']: int})
-    trans_df = pd.read_csv(join('data', 'filtered_data', f'filtered_bank_{bank}_trans.csv'), dtype={trans_cols['merchant_id']: int})
+    trans_fname = join('data', 'filtered_data', f'filtered_bank_{bank}_trans.csv')
+    trans_df = pd.read_csv(trans_fname, dtype={trans_cols['merchant_id']: int})
+    perf.read(trans_fname)
+    perf.rows_in = trans_df.shape[0]
 
     date_format = config['break_date']['date_format']
     break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
@@ -45,59 +88,171 @@ def const_trans_net(config, bank, overwrite=False):
     # bank_date_format = config['break_date'][f'bank_{bank}_date_format']
     # trans_df[trans_cols['tran_date']] = pd.to_datetime(trans_df[trans_cols['tran_date']], format=bank_date_format)
     trans_df[trans_cols['tran_date']] = pd.to_datetime(trans_df[trans_cols['tran_date']], format=date_format)
-    trans_df = trans_df[trans_df[trans_cols['tran_date']] <= break_date].set_index(trans_cols['merchant_id'])
+    trans_df = trans_df[trans_df[trans_cols['tran_date']] <= break_date]
+
+    # vertex index of a merchant is its code in the id dictionary
+    ids = load_id_dict(bank)
+    merchant_codes, customer_codes = trans_codes(trans_df, ids, trans_cols)
+    n_merchants = len(ids['merchant_ids'])
 
     # merchant districts and mcc
-    mcc_districts = pd.read_csv(join('data', 'filtered_data', f'bank_{bank}_merchant_districts.csv')).set_index(trans_cols['merchant_id'])
-    mcc_districts_lookup = set(mcc_districts.index)
-
-    mid_cs_list = []
-    for merchant in tqdm(np.unique(trans_df.index), desc='finding customers'):
-        customers = trans_df.loc[merchant, trans_cols['customer_id']]
-        if not isinstance(customers, pd.Series):
-            customers = pd.Series(customers)
-        cust_freq = customers.value_counts()
-        cur_s = cust_freq[cust_freq >= customer_min_trans]
-        if len(cur_s) > 0:
-            customer_set = set(cur_s.index.tolist())
-        else:
-            customer_set = set([])
-        mid_cs_list.append([merchant, customer_set])
-
-    edge_list = []
-    node_list = []
-    mcc_list = []
-    district_id_list = []
-    weights = []
-    for i in tqdm(range(len(mid_cs_list)), desc='creating edges'):
-        mid_i, cs_i = mid_cs_list[i]
-        mcc = mcc_districts.loc[mid_i, trans_cols['mcc']] if mid_i in mcc_districts_lookup else 'unk'
-        mcc_list.append(mcc)
-        district_id = mcc_districts.loc[mid_i, 'district_id'] if mid_i in mcc_districts_lookup else 'unk'
-        district_id_list.append(district_id)
-        node_list.append(mid_i)
-        for j in range(i + 1, len(mid_cs_list)):
-            mid_j, cs_j = mid_cs_list[j]
-            count = len(cs_i & cs_j)  # find the number of shared customers
-            if count > min_customer_num:
-                edge_list.append((mid_i, mid_j))
-                weights.append(count)
-
-    g = ig.Graph(directed=False)
-    # store merchant ids as str
-    g.add_vertices([str(node) for node in node_list])
-    g.add_edges([(str(i), str(j)) for i,j in edge_list])
+    mcc_list, district_id_list = merchant_attributes(config, bank, ids)
+
+    with perf_log.stage('creating_edges') as step:
+        step.rows_in = trans_df.shape[0]
+        src, dst, weights = co_customer_edges(merchant_codes, customer_codes, n_merchants, len(ids['customer_ids']),
+                                              customer_min_trans, min_customer_num)
+        step.rows_out = len(src)
+
+    g = ig.Graph(n=n_merchants, edges=np.column_stack([src, dst]).tolist(), directed=False)
     g.vs['mcc'] = mcc_list
     g.vs['district_id'] = district_id_list
-    g.es['weight'] = weights
+    g.es['weight'] = weights.tolist()
 
     g.write_pickle(output_file)
+    perf.wrote(output_file)
+    perf.rows_out = g.ecount()
 
-    num_merchants = len(node_list)
     unk_merchants = len([n for n in mcc_list if n == 'unk'])
-    logger.debug('bank {}, unk merchants count: {}, pct: {}'.format(bank, unk_merchants, unk_merchants/num_merchants*100))
+    logger.debug('bank {}, unk merchants count: {}, pct: {}'.format(bank, unk_merchants, unk_merchants/n_merchants*100))
     logger.debug('bank {}, graph # of nodes: {}, # of edges {}, density: {}'.format(bank, g.vcount(), g.ecount(), g.density()))
 
+
+def merchant_attributes(config, bank, ids):
+    '''
+    mcc and district id of every merchant code ('unk' if the merchant has no district)
+    '''
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+    mcc_districts = pd.read_csv(join('data', 'filtered_data', f'bank_{bank}_merchant_districts.csv')).set_index(trans_cols['merchant_id'])
+    mcc_districts = mcc_districts.astype(object).reindex(ids['merchant_ids']).fillna('unk')
+    return mcc_districts[trans_cols['mcc']].tolist(), mcc_districts['district_id'].tolist()
+
+
+def co_customer_edges(merchant_codes, customer_codes, n_merchants, n_customers, customer_min_trans, min_customer_num):
+    '''
+    merchant pairs sharing more than `min_customer_num` customers, customers count for a merchant
+    if they have at least `customer_min_trans` transactions there. returns (src, dst, weight) with src < dst.
+    '''
+    counts = sp.csr_matrix((np.ones(len(merchant_codes), dtype=np.int32), (merchant_codes, customer_codes)),
+                           shape=(n_merchants, n_customers))
+    counts.sum_duplicates()
+    counts.data = (counts.data >= customer_min_trans).astype(np.int32)
+    counts.eliminate_zeros()
+
+    shared = sp.triu(counts @ counts.T, k=1).tocoo()
+    keep = shared.data > min_customer_num
+    return shared.row[keep].astype(np.int32), shared.col[keep].astype(np.int32), shared.data[keep].astype(np.int32)
+
+
+@perf_log.stage('const_temporal_nets')
+def const_temporal_nets(config, bank, overwrite=False, after_break=False):
+    '''
+    construct merchant networks of every time window from a single pass over the transaction records.
+    windows end at the break date as in const_trans_net, after_break keeps the windows of the label
+    period as well (their features leak the labels).
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
+    window = config['network_conf']['temporal_window']
+    output_file = temporal_fname(bank, window)
+    if exists(output_file):
+        if not overwrite:
+            print(f'{output_file} already exists')
+            return
+        else:
+            os.remove(output_file)
+
+    customer_min_trans = config['network_conf']['customer_min_trans']
+    min_customer_num = config['network_conf']['min_customer_num']
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+
+    trans_fname = join('data', 'filtered_data', f'filtered_bank_{bank}_trans.csv')
+    usecols = [trans_cols['merchant_id'], trans_cols['customer_id'], trans_cols['tran_date'],
+               'merchant_code', 'customer_code', 'yyyymm']
+    trans_df = pd.read_csv(trans_fname, usecols=lambda c: c in usecols, dtype={trans_cols['merchant_id']: int})
+    perf.read(trans_fname)
+    perf.rows_in = trans_df.shape[0]
+
+    # labels are built from the transactions after the break date
+    if not after_break:
+        date_format = config['break_date']['date_format']
+        break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
+        trans_df = trans_df[pd.to_datetime(trans_df[trans_cols['tran_date']], format=date_format) <= break_date]
+
+    ids = load_id_dict(bank)
+    merchant_codes, customer_codes = trans_codes(trans_df, ids, trans_cols)
+    n_merchants, n_customers = len(ids['merchant_ids']), len(ids['customer_ids'])
+
+    # window of each transaction, counted in months from the first month
+    yyyymm = pd.to_datetime(trans_df['yyyymm'], format='%Y-%m')
+    month = (yyyymm.dt.year * 12 + yyyymm.dt.month).to_numpy()
+    window_codes = (month - month.min()) // window
+    n_windows = window_codes.max() + 1
+    windows = [(yyyymm.min() + pd.DateOffset(months=int(w * window))).strftime('%Y-%m') for w in range(n_windows)]
+
+    # group transactions by window once
+    order = np.argsort(window_codes, kind='stable')
+    bounds = np.searchsorted(window_codes[order], np.arange(n_windows + 1))
+
+    src_list, dst_list, weight_list = [], [], []
+    offsets = [0]
+    prev_keys = np.array([], dtype=np.int64)
+    for w in tqdm(range(n_windows), desc='creating window edges'):
+        rows = order[bounds[w]:bounds[w + 1]]
+        src, dst, weight = co_customer_edges(merchant_codes[rows], customer_codes[rows], n_merchants,
+                                             n_customers, customer_min_trans, min_customer_num)
+        src_list.append(src)
+        dst_list.append(dst)
+        weight_list.append(weight)
+        offsets.append(offsets[-1] + len(src))
+
+        keys = src.astype(np.int64) * n_merchants + dst
+        logger.debug('bank {}, window {}, # of edges: {}, gained: {}, lost: {}'.format(
+            bank, windows[w], len(src), (~np.isin(keys, prev_keys)).sum(), (~np.isin(prev_keys, keys)).sum()))
+        prev_keys = keys
+
+    # shared node table, row index is the merchant code
+    mcc_list, district_id_list = merchant_attributes(config, bank, ids)
+
+    np.savez_compressed(output_file,
+                        merchant_id=ids['merchant_ids'],
+                        mcc=np.array(mcc_list, dtype=str),
+                        district_id=np.array(district_id_list, dtype=str),
+                        windows=np.array(windows),
+                        after_break=after_break,
+                        offsets=np.array(offsets, dtype=np.int64),
+                        src=np.concatenate(src_list),
+                        dst=np.concatenate(dst_list),
+                        weight=np.concatenate(weight_list))
+    perf.wrote(output_file)
+    perf.rows_out = offsets[-1]
+
+    logger.debug('bank {}, temporal networks, # of windows: {} ({} - {}, after break date: {}), # of nodes: {}, total # of edges: {}'.format(
+        bank, n_windows, windows[0], windows[-1], after_break, n_merchants, offsets[-1]))
+
+
+def load_temporal_nets(fname):
+    '''
+    returns the node table and a list of per-window (src, dst, weight) edge arrays
+    '''
+    data = np.load(fname)
+    nodes = pd.DataFrame({'merchant_id': data['merchant_id'], 'mcc': data['mcc'], 'district_id': data['district_id']})
+    offsets = data['offsets']
+    edges = [(data['src'][offsets[w]:offsets[w + 1]],
+              data['dst'][offsets[w]:offsets[w + 1]],
+              data['weight'][offsets[w]:offsets[w + 1]]) for w in range(len(offsets) - 1)]
+    return nodes, data['windows'].tolist(), edges
+
+
+def temporal_after_break(fname):
+    '''
+    whether the temporal networks include the windows after the break date
+    '''
+    data = np.load(fname)
+    return 'after_break' in data.files and bool(data['after_break'])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create revenue/demographic/network features and well-being labels')
 
@@ -106,10 +261,21 @@ if __name__ == '__main__':
                         required=True,
                         help='bank name ("x", "y" or custom)')
 
+    parser.add_argument('-T', '--temporal',
+                        action='store_true',
+                        help='construct networks of every time window (network_conf.temporal_window months)')
+
+    parser.add_argument('-A', '--after-break',
+                        action='store_true',
+                        help='keep the temporal windows after the break date (label period, their features leak the labels)')
+
     args = parser.parse_args()
     bank = args.bank.lower()
 
     with open(join('config.yaml')) as f:
         config = yaml.safe_load(f)
 
-    const_trans_net(config, bank)
\ No newline at end of file
+    if args.temporal:
+        const_temporal_nets(config, bank, after_break=args.after_break)
+    else:
+        const_trans_net(config, bank)
\ No newline at end of file
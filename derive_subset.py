@@ -0,0 +1,187 @@
+import pandas as pd
+import numpy as np
+from os.path import join, exists
+import os
+from glob import glob
+import argparse
+import yaml
+import igraph as ig
+import logging
+import perf_log
+from generate_features_labels import generate_labels
+from id_dict import load_id_dict, save_id_dict, encode
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.FileHandler('.subsetlogfile', 'a')
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+def select_merchants(config, bank, mcc_list=None, district_list=None):
+    '''
+    ids of the merchants of the master dataset in the given mcc and district lists
+    '''
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+    merchants = pd.read_csv(join('data', 'filtered_data', f'bank_{bank}_merchant_districts.csv'))
+
+    selected = np.ones(merchants.shape[0], dtype=bool)
+    if mcc_list:
+        selected &= merchants[trans_cols['mcc']].isin(mcc_list).to_numpy()
+    if district_list:
+        selected &= merchants['district_id'].isin(district_list).to_numpy()
+    return merchants.loc[selected, trans_cols['merchant_id']].to_numpy()
+
+
+def subset_outputs(config, bank, fname_prefix):
+    '''
+    all files written for a subset, in the order they are written
+    '''
+    return [join('data', 'filtered_data', f'{fname_prefix}_bank_{bank}_ids.npz'),
+            join('data', 'filtered_data', f'{fname_prefix}_{config["trans_file_names"][f"bank_{bank}"]}'),
+            join('data', 'filtered_data', f'{fname_prefix}_{config["trans_file_names"]["agg"][f"bank_{bank}"]}'),
+            join('data', 'networks', f'{fname_prefix}_filtered_bank_{bank}.pickle'),
+            join('labels', f'{fname_prefix}_labels_{bank}.csv')]
+
+
+@perf_log.stage('derive_subset')
+def derive_subset(config, bank, fname_prefix, mcc_list=None, district_list=None, overwrite=False):
+    '''
+    derive the filtered transactions, aggregate summaries, network and labels of a
+    mcc/district subset from the master dataset without re-running the filters.
+    existing subset files are removed first with overwrite, otherwise nothing is written.
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+    perf.meta['prefix'] = fname_prefix
+
+    existing = [fname for fname in subset_outputs(config, bank, fname_prefix) if exists(fname)]
+    assert overwrite or not existing, f'subset {fname_prefix} already exists: {existing}, use --overwrite to replace it'
+    for fname in existing:
+        os.remove(fname)
+    if existing:
+        logger.debug('bank {}, subset {}, removed: {}'.format(bank, fname_prefix, existing))
+    features = glob(join('features', f'{fname_prefix}_*_{bank}*.csv'))
+    if features:
+        print(f'feature files of the previous {fname_prefix} subset are not updated: {features}')
+
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+    merchant_ids = select_merchants(config, bank, mcc_list, district_list)
+    assert len(merchant_ids) > 0, 'no merchants in the given subset'
+
+    print(f'deriving subset {fname_prefix} for bank {bank}: {len(merchant_ids)} merchants')
+
+    # subset id dictionary, merchant codes are re-numbered and customer codes are kept
+    ids = load_id_dict(bank)
+    codes = encode(merchant_ids, ids['merchant_ids'])
+    codes = np.sort(codes[codes >= 0])
+    subset_ids = {'merchant_ids': ids['merchant_ids'][codes], 'customer_ids': ids['customer_ids']}
+    save_id_dict(subset_ids, join('data', 'filtered_data', f'{fname_prefix}_bank_{bank}_ids.npz'))
+
+    # filtered transactions
+    trans_fname = config['trans_file_names'][f'bank_{bank}']
+    subset_trans_fname = join('data', 'filtered_data', f'{fname_prefix}_{trans_fname}')
+    with perf_log.stage('transactions') as step:
+        header = True
+        n_trans = 0
+        for df in pd.read_csv(join('data', 'filtered_data', trans_fname), chunksize=10**6 * 3,
+                              dtype={trans_cols['merchant_id']: int}):
+            df = df[df[trans_cols['merchant_id']].isin(merchant_ids)]
+            df['merchant_code'] = encode(df[trans_cols['merchant_id']], subset_ids['merchant_ids'])
+            df.to_csv(subset_trans_fname, header=header, index=False, mode='a')
+            header = False
+            n_trans += df.shape[0]
+        step.read(join('data', 'filtered_data', trans_fname))
+        step.wrote(subset_trans_fname)
+        step.rows_out = n_trans
+
+    # aggregate summaries
+    agg_fname = config['trans_file_names']['agg'][f'bank_{bank}']
+    with perf_log.stage('aggregates') as step:
+        agg_df = pd.read_csv(join('data', 'filtered_data', agg_fname), index_col=[0, 1, 2], header=[0, 1])
+        step.rows_in = agg_df.shape[0]
+        agg_df = agg_df[agg_df.index.get_level_values(0).isin(merchant_ids)]
+        agg_df.to_csv(join('data', 'filtered_data', f'{fname_prefix}_{agg_fname}'), index=True)
+        step.read(join('data', 'filtered_data', agg_fname))
+        step.wrote(join('data', 'filtered_data', f'{fname_prefix}_{agg_fname}'))
+        step.rows_out = agg_df.shape[0]
+
+    # shared customer counts of a merchant pair do not depend on the other merchants,
+    # so the induced subgraph of the master network is the network of the subset.
+    # vertex order is kept, so vertex indices are the subset merchant codes.
+    with perf_log.stage('network') as step:
+        net_fname = join('data', 'networks', f'filtered_bank_{bank}.pickle')
+        g = ig.Graph.Read_Pickle(net_fname)
+        step.rows_in = g.ecount()
+        sub_g = g.induced_subgraph(codes.tolist(), implementation='copy_and_delete')
+        sub_g.write_pickle(join('data', 'networks', f'{fname_prefix}_filtered_bank_{bank}.pickle'))
+        step.read(net_fname)
+        step.wrote(join('data', 'networks', f'{fname_prefix}_filtered_bank_{bank}.pickle'))
+        step.rows_out = sub_g.ecount()
+
+    logger.debug('bank {}, subset {}, mcc: {}, districts: {}'.format(bank, fname_prefix, mcc_list, district_list))
+    logger.debug('bank {}, subset {}, # of merchants: {}, # of transactions: {}, # of aggregate rows: {}'.format(
+        bank, fname_prefix, len(merchant_ids), n_trans, agg_df.shape[0]))
+    logger.debug('bank {}, subset {}, graph # of nodes: {}, # of edges {}, density: {}'.format(
+        bank, fname_prefix, sub_g.vcount(), sub_g.ecount(), sub_g.density()))
+
+    # per-mcc label thresholds are re-derived on the subset aggregates
+    generate_labels(config, bank, fname_prefix)
+    perf.rows_out = len(merchant_ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Derive a mcc/district subset from the master filtered dataset')
+
+    parser.add_argument(
+        '-B',
+        '--bank',
+        type=str,
+        required=True,
+        help='bank name ("x", "y" or custom)'
+    )
+
+    parser.add_argument(
+        '-P',
+        '--prefix',
+        type=str,
+        required=True,
+        help='output file name prefix of the subset'
+    )
+
+    parser.add_argument(
+        '-M',
+        '--mcc',
+        type=int,
+        required=False,
+        nargs='*',
+        help='mcc list of the subset'
+    )
+
+    parser.add_argument(
+        '-D',
+        '--district',
+        type=int,
+        required=False,
+        nargs='*',
+        help='district id list of the subset'
+    )
+
+    parser.add_argument(
+        '-W',
+        '--overwrite',
+        action='store_true',
+        help='remove the existing files of the subset before deriving it'
+    )
+
+    args = parser.parse_args()
+    bank = args.bank.lower()
+
+    with open(join('config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    derive_subset(config, bank, args.prefix, mcc_list=args.mcc, district_list=args.district,
+                  overwrite=args.overwrite)
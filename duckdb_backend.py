@@ -0,0 +1,273 @@
+import pandas as pd
+import numpy as np
+from os.path import join
+import argparse
+import yaml
+import time
+from datetime import datetime
+import duckdb
+import logging
+import perf_log
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.FileHandler('.duckdblogfile', 'a')
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+def q(col):
+    '''
+    quoted column identifier
+    '''
+    return '"{}"'.format(col.replace('"', '""'))
+
+
+@perf_log.stage('filters')
+def filter_transactions(config, bank, input_fname):
+    '''
+    transaction, merchant and mcc filters of the given bank as a single duckdb query, the
+    transactions are kept in file order as in the pandas engine
+    '''
+    cols = config['tran_cols'][f'bank_{bank}']
+    filters = config['trans_filter'][f'bank_{bank}']
+    date_format = config['break_date']['date_format']
+    bank_date_format = config['break_date'][f'bank_{bank}_date_format']
+
+    mid, mcc, tran_date = q(cols['merchant_id']), q(cols['mcc']), q(cols['tran_date'])
+    online = f"AND {q(cols['online_flag'])} = 0" if filters['remove_online'] else ''
+
+    query = f'''
+        WITH base AS (
+            SELECT *, row_number() OVER () AS _row
+            FROM read_csv($input, header = true, types = {{'{cols['tran_date']}': 'VARCHAR'}})
+            WHERE {mid} <> 999999 {online} AND {mcc} IN (SELECT unnest($mcc_list))
+        ), merchants AS (
+            SELECT {mid} FROM base GROUP BY {mid} HAVING count(*) >= $min_trans_count
+        ), mccs AS (
+            SELECT {mcc} FROM base SEMI JOIN merchants USING ({mid})
+            GROUP BY {mcc} HAVING count(*) >= $min_merchants_mcc
+        ), trans AS (
+            SELECT * REPLACE (strftime(strptime({tran_date}, $bank_date_format), $date_format) AS {tran_date}),
+                   strftime(strptime({tran_date}, $bank_date_format), '%Y-%m') AS yyyymm
+            FROM base SEMI JOIN merchants USING ({mid}) SEMI JOIN mccs USING ({mcc})
+        ), every_month AS (
+            SELECT {mid} FROM trans GROUP BY {mid}
+            HAVING (SELECT count(DISTINCT yyyymm) FROM trans) - count(DISTINCT yyyymm) <= 12 - $min_month_trans
+        )
+        SELECT * EXCLUDE (_row) FROM trans SEMI JOIN every_month USING ({mid}) ORDER BY _row
+    '''
+    with duckdb.connect() as con:
+        df = con.execute(query, {'input': input_fname,
+                                 'mcc_list': filters['mcc_list'],
+                                 'min_trans_count': filters['min_trans_count'],
+                                 'min_merchants_mcc': filters['min_merchants_mcc'],
+                                 'min_month_trans': filters['min_month_trans'],
+                                 'bank_date_format': bank_date_format,
+                                 'date_format': date_format}).df()
+    perf_log.current().rows_out = df.shape[0]
+    logger.debug('bank {}, duckdb filters, # of merchants: {}, # of transactions: {}'.format(
+        bank, df[cols['merchant_id']].nunique(), df.shape[0]))
+    return df
+
+
+def aggregate_summaries(df, cols):
+    '''
+    daily transaction count, distinct customers and revenue of every merchant
+    '''
+    mid, mcc, tran_date = q(cols['merchant_id']), q(cols['mcc']), q(cols['tran_date'])
+    customer, amount = q(cols['customer_id']), q(cols['tran_amount'])
+    with duckdb.connect() as con:
+        con.register('trans', df)
+        agg_df = con.execute(f'''
+            SELECT {mid}, {mcc}, {tran_date},
+                   count({customer}) AS c_count, count(DISTINCT {customer}) AS c_nunique,
+                   sum({amount}) AS a_sum, avg({amount}) AS a_mean
+            FROM trans
+            WHERE {mid} IS NOT NULL AND {mcc} IS NOT NULL AND {tran_date} IS NOT NULL
+            GROUP BY ALL
+            ORDER BY ALL
+        ''').df()
+    agg_df = agg_df.set_index([cols['merchant_id'], cols['mcc'], cols['tran_date']])
+    agg_df.columns = pd.MultiIndex.from_tuples([(cols['customer_id'], 'count'), (cols['customer_id'], 'nunique'),
+                                                (cols['tran_amount'], 'sum'), (cols['tran_amount'], 'mean')])
+    return agg_df
+
+
+def revenue_features(config, bank, fname_prefix):
+    '''
+    revenue features of the merchants before the break date. merchant totals and monthly
+    statistics are grouping sets of one scan over the filtered transactions.
+    '''
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+
+    trans_fname = f'filtered_bank_{bank}_trans.csv'
+    if fname_prefix:
+        trans_fname = f'{fname_prefix}_{trans_fname}'
+
+    date_format = config['break_date']['date_format']
+    break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
+
+    mid, customer = q(trans_cols['merchant_id']), q(trans_cols['customer_id'])
+    amount, tran_date = q(trans_cols['tran_amount']), q(trans_cols['tran_date'])
+
+    with duckdb.connect() as con:
+        df = con.execute(f'''
+            SELECT {mid} AS merchant_id, yyyymm, grouping(yyyymm) AS total,
+                   count(*) AS trans_count, sum({amount}) AS total_revenue,
+                   count(DISTINCT {customer}) AS unique_num_customers,
+                   avg({amount}) AS mean, stddev_samp({amount}) AS std
+            FROM read_csv($input, header = true, types = {{'{trans_cols['tran_date']}': 'VARCHAR', 'yyyymm': 'VARCHAR'}})
+            WHERE strptime({tran_date}, $date_format) <= $break_date
+            GROUP BY GROUPING SETS (({mid}), ({mid}, yyyymm))
+            ORDER BY merchant_id, yyyymm
+        ''', {'input': join('data', 'filtered_data', trans_fname),
+              'date_format': date_format,
+              'break_date': break_date}).df()
+
+    totals = df[df['total'] == 1].set_index('merchant_id')
+
+    monthly_rev = df[df['total'] == 0].pivot(index='merchant_id', columns='yyyymm', values=['mean', 'std'])
+    monthly_rev.columns = monthly_rev.columns.to_flat_index()
+
+    rev = pd.concat([totals[['trans_count', 'total_revenue', 'unique_num_customers']], monthly_rev], axis=1)
+    rev.index.name = trans_cols['merchant_id']
+    return rev
+
+
+def label_values(config, bank, fname_prefix):
+    '''
+    well-being labels from the change of average monthly revenues after the break date,
+    thresholded at the median change of each mcc
+    '''
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+
+    date_format = config['break_date']['date_format']
+    break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
+
+    agg_trans_fname = f'agg_bank_{bank}_trans.csv'
+    if fname_prefix:
+        agg_trans_fname = f'{fname_prefix}_{agg_trans_fname}'
+
+    # the aggregate file has a three row (column, statistic, index name) header
+    with duckdb.connect() as con:
+        df = con.execute('''
+            WITH agg AS (
+                SELECT merchant_id, mcc, strptime(tran_date, $date_format) AS tran_date, revenue
+                FROM read_csv($input, header = false, skip = 3,
+                              names = ['merchant_id', 'mcc', 'tran_date', 'count', 'nunique', 'revenue', 'mean'],
+                              types = {'tran_date': 'VARCHAR'})
+            ), monthly AS (
+                SELECT merchant_id, tran_date > $break_date AS second_half, month(tran_date) AS month,
+                       max(mcc) AS mcc, sum(revenue) AS revenue, count(*) AS n_rows
+                FROM agg
+                GROUP BY merchant_id, second_half, month
+            )
+            SELECT merchant_id, max(mcc) AS mcc,
+                   avg(revenue) FILTER (WHERE NOT second_half) AS avg_fh,
+                   avg(revenue) FILTER (WHERE second_half) AS avg_sh,
+                   sum(n_rows) AS n_rows
+            FROM monthly
+            GROUP BY merchant_id
+            ORDER BY merchant_id
+        ''', {'input': join('data', 'filtered_data', agg_trans_fname),
+              'date_format': date_format,
+              'break_date': break_date}).df()
+    perf = perf_log.current()
+    if perf is not None:
+        perf.rows_in = int(df['n_rows'].sum())
+
+    assert (df['avg_fh'].isna() == df['avg_sh'].isna()).all(), 'merchant id mismatch in labels'
+    df = df[df['avg_fh'].notna()]
+
+    revenue_change = ((df['avg_sh'] - df['avg_fh']) / df['avg_fh']).to_numpy()
+    mcc_median_change = pd.Series(revenue_change).groupby(df['mcc'].to_numpy()).transform('median').to_numpy()
+
+    labels = np.where(revenue_change >= mcc_median_change, 1.0,
+                      np.where(revenue_change < mcc_median_change, 0.0, revenue_change))
+    return pd.Series(labels, index=pd.Index(df['merchant_id'].to_numpy(), name=trans_cols['merchant_id']), name='label')
+
+
+def check_parity(config, bank, fname_prefix, stages):
+    '''
+    runs the pandas and duckdb engines of the given stages and asserts identical outputs,
+    floats are compared up to summation order (rtol 1e-9)
+    '''
+    import generate_features_labels
+
+    engines = {'revenue': (generate_features_labels.revenue_features, revenue_features),
+               'labels': (generate_features_labels.label_values, label_values)}
+    if 'filter' in stages:
+        # geopandas is only needed by the spatial filter, it is imported only for this stage
+        import filter_records
+        input_fname = join('data', f'bank_{bank}_transactions_customer_filters.csv')
+        engines['filter'] = (lambda config, bank, fname_prefix: filter_records.filter_transactions(config, bank, input_fname).reset_index(drop=True),
+                             lambda config, bank, fname_prefix: filter_transactions(config, bank, input_fname))
+        engines['aggregates'] = (lambda config, bank, fname_prefix: filter_records.aggregate_summaries(
+                                     filter_records.filter_transactions(config, bank, input_fname), config['tran_cols'][f'bank_{bank}']),
+                                 lambda config, bank, fname_prefix: aggregate_summaries(
+                                     filter_transactions(config, bank, input_fname), config['tran_cols'][f'bank_{bank}']))
+        stages = list(stages) + ['aggregates']
+
+    rows = []
+    for stage_name in stages:
+        outputs, elapsed = {}, {}
+        for engine, fn in zip(['pandas', 'duckdb'], engines[stage_name]):
+            with perf_log.stage(f'parity_{stage_name}', engine=engine) as step:
+                start = time.perf_counter()
+                outputs[engine] = fn(config, bank, fname_prefix)
+                elapsed[engine] = time.perf_counter() - start
+                step.rows_out = outputs[engine].shape[0]
+
+        if isinstance(outputs['pandas'], pd.Series):
+            pd.testing.assert_series_equal(outputs['pandas'], outputs['duckdb'], check_exact=False, rtol=1e-9)
+        else:
+            pd.testing.assert_frame_equal(outputs['pandas'], outputs['duckdb'], check_exact=False, rtol=1e-9)
+        rows.append({'stage': stage_name, 'rows': outputs['pandas'].shape[0],
+                     'pandas_sec': elapsed['pandas'], 'duckdb_sec': elapsed['duckdb']})
+
+    parity_df = pd.DataFrame(rows).set_index('stage')
+    logger.debug('bank {}, prefix {}, pandas/duckdb parity ok\n{}'.format(bank, fname_prefix, parity_df.to_string()))
+    return parity_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the pandas and duckdb engines give identical outputs')
+
+    parser.add_argument(
+        '-B',
+        '--bank',
+        type=str,
+        required=True,
+        help='bank name ("x", "y" or custom)'
+    )
+
+    parser.add_argument(
+        '-P',
+        '--prefix',
+        type=str,
+        required=False,
+        help='input file name prefix'
+    )
+
+    parser.add_argument(
+        '-S',
+        '--stages',
+        type=str,
+        nargs='*',
+        choices=['filter', 'revenue', 'labels'],
+        default=['revenue', 'labels'],
+        help='stages to compare (filter needs the raw transactions and geopandas)'
+    )
+
+    args = parser.parse_args()
+    bank = args.bank.lower()
+
+    with open(join('config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    print(check_parity(config, bank, args.prefix, args.stages).to_string())
+    print('pandas and duckdb outputs are identical')
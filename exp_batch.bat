@@ -1,3 +1,4 @@
+set PERF_RUN_ID=exp_batch_%RANDOM%%RANDOM%
 python spatial_filter.py
 python filter_records.py --bank x
 python construct_network.py --bank x
@@ -7,3 +8,5 @@ python run_experiment.py -O results/ -E only_5411 -L labels/labels_x.csv -F feat
 python run_experiment.py -O results/ -E only_5411 -L labels/labels_x.csv -F features/filtered_network_features_weight_x.csv
 python run_experiment.py -O results/ -E only_5411 -L labels/labels_x.csv -F features/demographics_x.csv features/revenue_x.csv
 python run_experiment.py -O results/ -E only_5411 -L labels/labels_x.csv -F features/demographics_x.csv features/revenue_x.csv features/filtered_network_features_weight_x.csv
+
+python perf_log.py --top 15
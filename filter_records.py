@@ -6,31 +6,26 @@ import argparse
 import geopandas as gpd
 import logging
 import os
+import perf_log
+from id_dict import build_id_dict, save_id_dict, encode
 
 logfname = '.filterlogfile'
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-ch = logging.FileHandler(logfname, mode='w')
+ch = logging.FileHandler(logfname, mode='a')
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def filter_trans_records(config, bank, fname_prefix):
+@perf_log.stage('filters')
+def filter_transactions(config, bank, input_fname):
     '''
-    filter credit transactions for the given bank
+    apply the transaction, merchant and mcc filters of the given bank (pandas engine)
     '''
-    fname = config['trans_file_names'][f'bank_{bank}']
-    if fname_prefix:
-        fname = '{}_{}'.format(fname_prefix, fname)
-
-    output_fname = join('data', 'filtered_data', fname)
-
-    print(f'filtering transactions for bank: {bank}')
-
-    #df = pd.read_csv(join('data', f'bank_{bank}_transactions.csv'))
-    df = pd.read_csv(join('data', f'bank_{bank}_transactions_customer_filters.csv'))
+    df = pd.read_csv(input_fname)
+    perf_log.current().rows_in = df.shape[0]
 
     cols = config['tran_cols'][f'bank_{bank}']
     filters = config['trans_filter'][f'bank_{bank}']
@@ -71,6 +66,44 @@ def filter_trans_records(config, bank, fname_prefix):
                                                                         cols['tran_amount']: ['sum', 'mean']}).unstack()
     merchants_every_month = monthly_agg_df[monthly_agg_df[cols['customer_id']]['count'].isnull().sum(axis=1) <= (12 - filters['min_month_trans'])].index.tolist()
     df = df[df[cols['merchant_id']].isin(merchants_every_month)]
+    perf_log.current().rows_out = df.shape[0]
+    return df
+
+
+def aggregate_summaries(df, cols):
+    '''
+    daily transaction count, distinct customers and revenue of every merchant (pandas engine)
+    '''
+    return df.groupby([cols['merchant_id'], cols['mcc'], cols['tran_date']]).agg({cols['customer_id']: ['count', 'nunique'], cols['tran_amount']: ['sum', 'mean']})
+
+
+@perf_log.stage('filter_trans_records')
+def filter_trans_records(config, bank, fname_prefix, engine='pandas'):
+    '''
+    filter credit transactions for the given bank
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+    perf.meta['engine'] = engine
+
+    fname = config['trans_file_names'][f'bank_{bank}']
+    if fname_prefix:
+        fname = '{}_{}'.format(fname_prefix, fname)
+
+    output_fname = join('data', 'filtered_data', fname)
+
+    print(f'filtering transactions for bank: {bank}')
+
+    #df = pd.read_csv(join('data', f'bank_{bank}_transactions.csv'))
+    input_fname = join('data', f'bank_{bank}_transactions_customer_filters.csv')
+    if engine == 'duckdb':
+        import duckdb_backend
+        df = duckdb_backend.filter_transactions(config, bank, input_fname)
+    else:
+        df = filter_transactions(config, bank, input_fname)
+    perf.read(input_fname)
+
+    cols = config['tran_cols'][f'bank_{bank}']
 
     logger.debug('bank {}, [BEFORE SPATIAL FILTER] # of merchants: {}'.format(bank, df[cols["merchant_id"]].nunique()))
     logger.debug('bank {}, [BEFORE SPATIAL FILTER] # of transactions: {}'.format(bank, df.shape[0]))
@@ -83,7 +116,10 @@ def filter_trans_records(config, bank, fname_prefix):
     latlngs = gpd.GeoDataFrame(latlngs, geometry=gpd.points_from_xy(latlngs[cols['merchant_lng']], latlngs[cols['merchant_lat']]), crs='EPSG:4326')
 
     # spatial join
-    latlngs = gpd.sjoin(latlngs, shp, how='inner', op='within')
+    with perf_log.stage('spatial_join') as step:
+        step.rows_in = latlngs.shape[0]
+        latlngs = gpd.sjoin(latlngs, shp, how='inner', op='within')
+        step.rows_out = latlngs.shape[0]
     latlngs[[cols['merchant_id'], cols['mcc'], 'district_id']].to_csv(join('data', 'filtered_data', f'bank_{bank}_merchant_districts.csv'), index=False)
 
     df = df.loc[df[cols['merchant_id']].isin(latlngs[cols['merchant_id']])]
@@ -93,30 +129,56 @@ def filter_trans_records(config, bank, fname_prefix):
 
     logger.debug('bank {}, nan districts: {}'.format(bank, latlngs.isna().sum()))
 
+    # dense integer codes of merchants and customers used by the later stages
+    ids = build_id_dict(df[cols['merchant_id']], df[cols['customer_id']])
+    ids_fname = 'bank_{}_ids.npz'.format(bank)
+    if fname_prefix:
+        ids_fname = '{}_{}'.format(fname_prefix, ids_fname)
+    save_id_dict(ids, join('data', 'filtered_data', ids_fname))
+    df['merchant_code'] = encode(df[cols['merchant_id']], ids['merchant_ids'])
+    df['customer_code'] = encode(df[cols['customer_id']], ids['customer_ids'])
+
+    logger.debug('bank {}, id dictionary, # of merchants: {}, # of customers: {}'.format(bank, len(ids['merchant_ids']), len(ids['customer_ids'])))
+
     df.to_csv(output_fname, index=False)
+    perf.wrote(output_fname)
+    perf.rows_out = df.shape[0]
 
     print('merchant district extraction done')
     print('obtaining aggregate transaction summaries')
 
     # record aggregated summaries
-    agg_df = df.groupby([cols['merchant_id'], cols['mcc'], cols['tran_date']]).agg({cols['customer_id']: ['count', 'nunique'], cols['tran_amount']: ['sum', 'mean']})
-
-    agg_fname = config['trans_file_names']['agg'][f'bank_{bank}']
-    if fname_prefix:
-        agg_fname = '{}_{}'.format(fname_prefix, agg_fname)
-    agg_df.to_csv(join('data', 'filtered_data', agg_fname), index=True)
-
-
+    with perf_log.stage('aggregate_summaries') as step:
+        step.rows_in = df.shape[0]
+        if engine == 'duckdb':
+            agg_df = duckdb_backend.aggregate_summaries(df, cols)
+        else:
+            agg_df = aggregate_summaries(df, cols)
+
+        agg_fname = config['trans_file_names']['agg'][f'bank_{bank}']
+        if fname_prefix:
+            agg_fname = '{}_{}'.format(fname_prefix, agg_fname)
+        agg_df.to_csv(join('data', 'filtered_data', agg_fname), index=True)
+        step.rows_out = agg_df.shape[0]
+        step.wrote(join('data', 'filtered_data', agg_fname))
+
+
+@perf_log.stage('assign_customer_district_ids')
 def assign_customer_district_ids(config, bank):
     '''
     assign district ids to customer home and work locations based on their lat/lngs
     '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
     customer_df_fname = join('data', f'bank_{bank}_customers.csv')
     output_fname = join('data', 'filtered_data', f'bank_{bank}_customers_districts.csv')
 
     print('assigning customer home and work districts')
 
     customer_df = pd.read_csv(customer_df_fname)
+    perf.read(customer_df_fname)
+    perf.rows_in = customer_df.shape[0]
     shp = gpd.read_file(join('data', config['shpfiles'][f'bank_{bank}']))
 
     cols = config['customer_cols'][f'bank_{bank}']
@@ -140,6 +202,8 @@ def assign_customer_district_ids(config, bank):
     result = combined_districts.drop('geometry', axis=1)
     logger.debug('bank {}, customer districts nan value percentages: {}'.format(bank, result[['home_district_id', 'work_district_id']].isna().sum() / result.shape[0]))
     result.to_csv(output_fname, index=False)
+    perf.wrote(output_fname)
+    perf.rows_out = result.shape[0]
 
 
 if __name__ == '__main__':
@@ -170,6 +234,15 @@ if __name__ == '__main__':
         help='mcc list to be considered'
     )
 
+    parser.add_argument(
+        '-E',
+        '--engine',
+        type=str,
+        choices=['pandas', 'duckdb'],
+        default='pandas',
+        help='query engine of the filters and aggregate summaries'
+    )
+
     args = parser.parse_args()
     bank = args.bank.lower()
     fname_prefix = args.prefix
@@ -181,5 +254,5 @@ if __name__ == '__main__':
     if mcc_list:
         config['trans_filter'][f'bank_{bank}']['mcc_list'] = mcc_list
 
-    filter_trans_records(config, bank, fname_prefix)
+    filter_trans_records(config, bank, fname_prefix, engine=args.engine)
     assign_customer_district_ids(config, bank)
\ No newline at end of file
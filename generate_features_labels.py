@@ -4,16 +4,21 @@ from os.path import join, exists
 import argparse
 import yaml
 from datetime import datetime
+import time
 import igraph as ig
+import scipy.sparse as sp
 from tqdm import tqdm
 import logging
 from tqdm import tqdm
 import os
+import perf_log
+from construct_network import load_temporal_nets, temporal_after_break, temporal_fname, network_fname, network_id_dict
+from id_dict import load_id_dict, encode, decode, trans_codes
 
 logfname = '.featurelogfile'
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-ch = logging.FileHandler(logfname, 'w')
+ch = logging.FileHandler(logfname, 'a')
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 ch.setFormatter(formatter)
@@ -31,40 +36,37 @@ def calc_entropy(s):
     return (prob_s * np.log(1.0 / prob_s)).sum()
 
 
-def create_network(config, bank, fname_prefix, weights='weight'):
+def filtered_merchants(config, bank, fname_prefix, ids):
     '''
-    creates merchant networks for the given bank type
+    codes of the merchants in the filtered transactions. merchant ids are encoded with the
+    dictionary of the network (network_id_dict), which is not necessarily the dictionary of
+    the transaction codes.
     '''
-    # fname = f'network_features_{weights}_{bank}.csv'
-    fname = f'filtered_network_features_{weights}_{bank}.csv'
-    if fname_prefix:
-        fname = f'{fname_prefix}_{fname}'
-
-    output_fname = join('features', fname)
-
-    if exists(output_fname):
-        print(f'{output_fname} already exists')
-        return
-
-    print('extracting network features')
-
-    g = ig.Graph(directed=False)
-    # g = g.Read_Pickle(join('data', 'networks', f'bank_{bank}.pickle'))
-    g = g.Read_Pickle(join('data', 'networks', f'filtered_bank_{bank}.pickle'))
-
     trans_cols = config['tran_cols'][f'bank_{bank}']
     trans_fname = f'filtered_bank_{bank}_trans.csv'
     if fname_prefix:
         trans_fname = f'{fname_prefix}_{trans_fname}'
     transaction_df = pd.read_csv(join('data', 'filtered_data', trans_fname), 
                                       usecols=[trans_cols['merchant_id']], dtype={trans_cols['merchant_id']: int})
+    perf = perf_log.current()
+    perf.read(join('data', 'filtered_data', trans_fname))
+    perf.rows_in = transaction_df.shape[0]
 
-    # get filtered merchants
-    merchants = transaction_df[trans_cols['merchant_id']].astype(str).unique()
-    net_df = pd.DataFrame(merchants, columns=['merchant_id'])
+    merchants = encode(transaction_df[trans_cols['merchant_id']].unique(), ids['merchant_ids'])
+    if (merchants < 0).any():
+        logger.debug('bank {}, merchants missing in the network: {}'.format(bank, (merchants < 0).sum()))
+    return merchants[merchants >= 0]
+
+
+def network_features(g, merchants, ids, weights='weight'):
+    '''
+    diversity and centrality features of the given merchant codes in the merchant network
+    '''
+    net_df = pd.DataFrame(decode(merchants, ids['merchant_ids']), columns=['merchant_id'])
 
-    nodes = np.array([node['name'] for node in g.vs])
-    node2ind = [np.where(nodes == merchant)[0][0] for merchant in merchants]
+    # vertex indices are merchant codes
+    node2ind = merchants
+    merchants = merchants.tolist()
 
     mcc_div = []
     dist_div = []
@@ -89,24 +91,291 @@ def create_network(config, bank, fname_prefix, weights='weight'):
              ]
 
     for name, func, params in tqdm(models, desc='centrality metrics'):
-        if name == 'eigenvector':
-            eigs = np.array(func(**params))
-            net_df[name] = eigs[node2ind]
-        else:
-            net_df[name] = func(vertices=merchants, **params)
+        with perf_log.stage(f'centrality_{name}', vcount=g.vcount(), ecount=g.ecount()) as step:
+            if name == 'eigenvector':
+                eigs = np.array(func(**params))
+                net_df[name] = eigs[node2ind]
+            else:
+                net_df[name] = func(vertices=merchants, **params)
+            step.rows_out = len(merchants)
+
+    return net_df.set_index('merchant_id')
+
+
+@perf_log.stage('create_network')
+def create_network(config, bank, fname_prefix, weights='weight'):
+    '''
+    creates merchant networks for the given bank type
+    '''
+    perf = perf_log.current()
+    perf.meta.update({'bank': bank, 'prefix': fname_prefix, 'weights': weights})
+
+    # fname = f'network_features_{weights}_{bank}.csv'
+    fname = f'filtered_network_features_{weights}_{bank}.csv'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+
+    output_fname = join('features', fname)
+
+    if exists(output_fname):
+        print(f'{output_fname} already exists')
+        return
+
+    print('extracting network features')
+
+    g = ig.Graph(directed=False)
+    # g = g.Read_Pickle(join('data', 'networks', f'bank_{bank}.pickle'))
+    net_fname = network_fname(bank, fname_prefix)
+    g = g.Read_Pickle(net_fname)
+    perf.read(net_fname)
+
+    # get filtered merchants
+    ids = network_id_dict(bank, fname_prefix)
+    merchants = filtered_merchants(config, bank, fname_prefix, ids)
+    start = time.perf_counter()
+    net_df = network_features(g, merchants, ids, weights)
+    feature_sec = time.perf_counter() - start
+    perf.meta['feature_sec'] = round(feature_sec, 4)
 
     logger.debug('bank {}, network features, # of rows: {}, # of columns: {}'.format(bank, net_df.shape[0], net_df.shape[1]))
     logger.debug('bank {}, nan_values: {}'.format(bank, net_df.isna().sum()))
 
-    net_df = net_df.set_index('merchant_id')
-    net_df.index = net_df.index.astype(int)
     net_df.to_csv(output_fname)
+    perf.wrote(output_fname)
+    perf.rows_out = net_df.shape[0]
+    return feature_sec
+
+
+def logged_feature_sec(bank, fname_prefix, weights='weight'):
+    '''
+    network feature time of the latest create_network run of the full network in the perf log
+    '''
+    if not exists(perf_log.PERF_LOG):
+        return None
+    df = perf_log.load_log()
+    if 'feature_sec' not in df.columns:
+        return None
+    df = df[(df['stage'] == 'create_network') & df['feature_sec'].notna() &
+            (df['bank'] == bank) & (df['weights'].fillna('') == (weights or '')) &
+            (df['prefix'].fillna('') == (fname_prefix or ''))]
+    return df['feature_sec'].iloc[-1] if len(df) else None
+
+
+def threshold_graphs(g, thresholds):
+    '''
+    yields (threshold, graph) pairs keeping the edges with more than `threshold` shared customers.
+    edge weights are sorted once and every threshold is a single cut of the sorted edges.
+    '''
+    w = np.array(g.es['weight'])
+    order = np.argsort(w, kind='stable')
+    sorted_w = w[order]
+    for threshold in sorted(thresholds):
+        start = np.searchsorted(sorted_w, threshold, side='right')
+        yield threshold, g.subgraph_edges(np.sort(order[start:]).tolist(), delete_vertices=False)
+
+
+def disparity_backbone(g, alpha):
+    '''
+    disparity filter backbone (serrano et al., 2009): keeps the edges whose weight is significant
+    at level `alpha` for at least one of their endpoints
+    '''
+    edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    w = np.array(g.es['weight'], dtype=float)
+    strength = np.array(g.strength(weights='weight'), dtype=float)
+    degree = np.array(g.degree())
+
+    def p_value(node):
+        k = degree[node]
+        return np.where(k > 1, (1 - w / strength[node]) ** (k - 1), 1.0)
+
+    significance = np.minimum(p_value(edges[:, 0]), p_value(edges[:, 1]))
+    return g.subgraph_edges(np.where(significance < alpha)[0].tolist(), delete_vertices=False)
+
+
+@perf_log.stage('create_network_sweep')
+def create_network_sweep(config, bank, fname_prefix, weights='weight', thresholds=None, alpha=None, full_sec=None):
+    '''
+    creates network features of graphs derived from the full merchant network, one per
+    `min_customer_num` threshold and/or the disparity filter backbone.
+    full_sec is the network feature time of the full network (returned by create_network),
+    taken from the perf log when not given. thresholds that remove no edges are skipped.
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
+    fname = f'filtered_network_features_{weights}_{bank}'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
 
+    derived = []
+    if thresholds:
+        derived += [(f'_t{t}', t) for t in thresholds]
+    if alpha:
+        derived += [(f'_bb{alpha}', None)]
+    derived = [(join('features', f'{fname}{suffix}.csv'), t) for suffix, t in derived]
+    derived = [(output_fname, t) for output_fname, t in derived if not exists(output_fname)]
+    if not derived:
+        print('network sweep features already exist')
+        return
+
+    print('extracting network sweep features')
+
+    net_fname = network_fname(bank, fname_prefix)
+    g = ig.Graph.Read_Pickle(net_fname)
+    perf.read(net_fname)
+    ids = network_id_dict(bank, fname_prefix)
+    merchants = filtered_merchants(config, bank, fname_prefix, ids)
+
+    min_customer_num = config['network_conf']['min_customer_num']
+    # edges of the full network already have more than min_customer_num shared customers
+    assert all(t is None or t > min_customer_num for _, t in derived), \
+        f'thresholds should be greater than network_conf.min_customer_num ({min_customer_num})'
+
+    # feature extraction time of the full network as the baseline
+    if full_sec is None:
+        full_sec = logged_feature_sec(bank, fname_prefix, weights)
+
+    graphs = dict(threshold_graphs(g, [t for _, t in derived if t is not None]))
+    if alpha:
+        graphs[None] = disparity_backbone(g, alpha)
+
+    for output_fname, t in derived:
+        sub_g = graphs[t]
+        name = f'threshold_{t}' if t is not None else f'backbone_{alpha}'
+        if sub_g.ecount() == g.ecount():
+            print(f'{name} removes no edges, skipping')
+            logger.debug('bank {}, {}, removes no edges of the network, skipped'.format(bank, name))
+            continue
+        start = time.perf_counter()
+        with perf_log.stage(name, ecount=sub_g.ecount()) as step:
+            net_df = network_features(sub_g, merchants, ids, weights)
+            net_df.to_csv(output_fname)
+            step.wrote(output_fname)
+            step.rows_out = net_df.shape[0]
+        sub_sec = time.perf_counter() - start
+
+        logger.debug('bank {}, {}, # of edges: {} -> {} ({:.1f}% removed), network feature time: {}'.format(
+            bank, name, g.ecount(), sub_g.ecount(), (1 - sub_g.ecount() / max(g.ecount(), 1)) * 100,
+            '{:.2f}s -> {:.2f}s ({:.2f}s saved)'.format(full_sec, sub_sec, full_sec - sub_sec)
+            if full_sec is not None else '{:.2f}s (no full network baseline)'.format(sub_sec)))
+
+
+def batched_pagerank(adj, block_size, damping=0.85, tol=1e-10, max_iter=1000):
+    '''
+    pagerank of every diagonal block of a block-diagonal adjacency matrix at once.
+    dangling nodes and teleports jump uniformly within their own block.
+    '''
+    n_total = adj.shape[0]
+    block = np.arange(n_total) // block_size
+    out_weight = np.asarray(adj.sum(axis=1)).ravel()
+    dangling = out_weight == 0
+    trans = (sp.diags(np.where(dangling, 0, 1.0 / np.where(dangling, 1, out_weight))) @ adj).T.tocsr()
+
+    x = np.full(n_total, 1.0 / block_size)
+    for _ in range(max_iter):
+        dangling_mass = np.bincount(block, weights=x * dangling, minlength=n_total // block_size)
+        x_new = damping * (trans @ x + dangling_mass[block] / block_size) + (1 - damping) / block_size
+        converged = np.abs(x_new - x).max() < tol
+        x = x_new
+        if converged:
+            break
+    return x
+
+
+@perf_log.stage('create_temporal_network')
+def create_temporal_network(config, bank, fname_prefix, weights='weight'):
+    '''
+    creates per-window centrality features of the temporal merchant networks
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
+    window = config['network_conf']['temporal_window']
+    fname = f'temporal_network_features_{weights}_{bank}_w{window}.csv'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+
+    output_fname = join('features', fname)
 
+    if exists(output_fname):
+        print(f'{output_fname} already exists')
+        return
+
+    # the temporal networks cover all merchants of the master dataset
+    net_fname = temporal_fname(bank, window, fname_prefix)
+    assert net_fname is not None, f'there are no temporal networks of {fname_prefix}, run without --prefix'
+
+    print('extracting temporal network features')
+
+    nodes, windows, window_edges = load_temporal_nets(net_fname)
+    perf.read(net_fname)
+    if temporal_after_break(net_fname):
+        print(f'{net_fname} includes the windows after the break date, the features leak the labels')
+        logger.debug('bank {}, temporal networks include the label period: {}'.format(bank, windows))
+
+    # all windows as one disjoint union graph so every metric is computed in a single call
+    n = nodes.shape[0]
+    shift = [np.full(len(src), w * n, dtype=np.int64) for w, (src, _, _) in enumerate(window_edges)]
+    src = np.concatenate([e[0] for e in window_edges]) + np.concatenate(shift)
+    dst = np.concatenate([e[1] for e in window_edges]) + np.concatenate(shift)
+    weight = np.concatenate([e[2] for e in window_edges]).astype(float)
+    perf.rows_in = len(src)
+
+    g = ig.Graph(n=n * len(windows), edges=np.column_stack([src, dst]).tolist(), directed=False)
+    g.es['weight'] = weight
+
+    net_df = pd.DataFrame({'merchant_id': np.tile(nodes['merchant_id'].to_numpy(), len(windows)),
+                           'window': np.repeat(windows, n)})
+
+    # closeness, betweenness and degree of a vertex only depend on its own component (window).
+    # pagerank teleports across components, so it is computed with a block-wise power iteration.
+    models = [('degree', g.degree, {'mode': 'all'}),
+              ('closeness', g.closeness, {'weights': weights, 'mode': 'all', 'cutoff': None, 'normalized': True}),
+              ('betweenness', g.betweenness, {'weights': weights, 'directed': False, 'cutoff': None})]
+
+    with perf_log.stage('centrality_pr', vcount=g.vcount(), ecount=g.ecount()) as step:
+        adj_weight = weight if weights else np.ones(len(src))
+        adj = sp.csr_matrix((np.concatenate([adj_weight, adj_weight]), (np.concatenate([src, dst]), np.concatenate([dst, src]))),
+                            shape=(g.vcount(), g.vcount()))
+        net_df['pr'] = batched_pagerank(adj, n, damping=0.85)
+        step.rows_out = g.vcount()
+
+    for name, func, params in tqdm(models, desc='centrality metrics'):
+        with perf_log.stage(f'centrality_{name}', vcount=g.vcount(), ecount=g.ecount()) as step:
+            net_df[name] = func(**params)
+            step.rows_out = g.vcount()
+
+    # edges gained and lost by every merchant compared to the previous window
+    gained = np.zeros(n * len(windows), dtype=np.int64)
+    lost = np.zeros(n * len(windows), dtype=np.int64)
+    prev_src, prev_dst = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    for w, (w_src, w_dst, _) in enumerate(window_edges):
+        keys, prev_keys = w_src.astype(np.int64) * n + w_dst, prev_src * n + prev_dst
+        new_edges = ~np.isin(keys, prev_keys)
+        dropped_edges = ~np.isin(prev_keys, keys)
+        gained[w * n:(w + 1) * n] = np.bincount(np.concatenate([w_src[new_edges], w_dst[new_edges]]), minlength=n)
+        lost[w * n:(w + 1) * n] = np.bincount(np.concatenate([prev_src[dropped_edges], prev_dst[dropped_edges]]), minlength=n)
+        prev_src, prev_dst = w_src.astype(np.int64), w_dst.astype(np.int64)
+    net_df['edges_gained'] = gained
+    net_df['edges_lost'] = lost
+
+    logger.debug('bank {}, temporal network features, # of windows: {}, # of rows: {}, # of columns: {}'.format(
+        bank, len(windows), net_df.shape[0], net_df.shape[1]))
+    logger.debug('bank {}, nan_values: {}'.format(bank, net_df.isna().sum()))
+
+    net_df.to_csv(output_fname, index=False)
+    perf.wrote(output_fname)
+    perf.rows_out = net_df.shape[0]
+
+
+@perf_log.stage('create_demographics')
 def create_demographics(config, bank, fname_prefix):
     '''
     construct demographic features
     '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
     fname = f'demographics_{bank}.csv'
     if fname_prefix:
         fname = f'{fname_prefix}_{fname}'
@@ -127,6 +396,9 @@ def create_demographics(config, bank, fname_prefix):
         trans_fname = f'{fname_prefix}_{trans_fname}'
     transaction_df = pd.read_csv(join('data', 'filtered_data', trans_fname), dtype={trans_cols['merchant_id']: int})
     customer_df = pd.read_csv(join('data', 'filtered_data', f'bank_{bank}_customers_districts.csv'))
+    perf.read(join('data', 'filtered_data', trans_fname))
+    perf.read(join('data', 'filtered_data', f'bank_{bank}_customers_districts.csv'))
+    perf.rows_in = transaction_df.shape[0]
 
     income = customer_cols['income']
     age = customer_cols['age']
@@ -144,12 +416,17 @@ def create_demographics(config, bank, fname_prefix):
     transaction_df[trans_cols['tran_date']] = pd.to_datetime(transaction_df[trans_cols['tran_date']], format=date_format)
     transaction_df = transaction_df[transaction_df[trans_cols['tran_date']] <= break_date]
 
+    ids = load_id_dict(bank, fname_prefix)
+    merchant_codes, customer_codes = trans_codes(transaction_df, ids, trans_cols)
+
+    # customer attributes indexed by customer code
+    customer_df.index = encode(customer_df[customer_cols['customer_id']], ids['customer_ids'])
+    customer_df = customer_df[customer_df.index >= 0]
+
     merchantid_list = []
     feature_dict_list = []
-    for merchantid, group_df in transaction_df.groupby([trans_cols['merchant_id']]):
-    #for merchantid, group_df in transaction_df[transaction_df[trans_cols['mcc']].isin([5411])].groupby([trans_cols['merchant_id']]):
-        customerid_set = set(group_df[trans_cols['customer_id']].tolist())
-        cur_df = customer_df[customer_df[customer_cols['customer_id']].isin(customerid_set)]
+    for merchant_code, customer_group in pd.Series(customer_codes).groupby(merchant_codes):
+        cur_df = customer_df.loc[customer_df.index.intersection(customer_group.unique())]
 
         feature_dict = {
             # income
@@ -172,38 +449,31 @@ def create_demographics(config, bank, fname_prefix):
             'marital_ent': calc_entropy(cur_df[marital_st]),
             'employment_ent': calc_entropy(cur_df[emp])}
 
-        merchantid_list.append(merchantid)
+        merchantid_list.append(merchant_code)
         feature_dict_list.append(feature_dict)
 
     feature_df = pd.DataFrame(feature_dict_list)
-    feature_df.index = merchantid_list
+    feature_df.index = decode(merchantid_list, ids['merchant_ids'])
     logger.debug('bank {}, demographic features, # of rows: {}, # of columns: {}'.format(bank, feature_df.shape[0], feature_df.shape[1]))
     logger.debug('bank {}, nan_values: {}'.format(bank, feature_df.isna().sum()))
     feature_df.to_csv(output_fname)
+    perf.wrote(output_fname)
+    perf.rows_out = feature_df.shape[0]
 
 
-def create_revenue_features(config, bank, fname_prefix):
+def revenue_features(config, bank, fname_prefix):
     '''
-    create features based on revenur for the given bank type 
+    revenue features of the merchants before the break date (pandas engine)
     '''
-    fname = f'revenue_{bank}.csv'
-    if fname_prefix:
-        fname = f'{fname_prefix}_{fname}'
-
-    output_fname = join('features', fname)
-
-    if exists(output_fname):
-        print(f'{output_fname} already exists')
-        return
-
-    print('extracting revenue features')
-
     trans_cols = config['tran_cols'][f'bank_{bank}']
 
     trans_fname = f'filtered_bank_{bank}_trans.csv'
     if fname_prefix:
         trans_fname = f'{fname_prefix}_{trans_fname}'
     transaction_df = pd.read_csv(join('data', 'filtered_data', trans_fname), dtype={trans_cols['merchant_id']: int})
+    perf = perf_log.current()
+    if perf is not None:
+        perf.rows_in = transaction_df.shape[0]
 
     date_format = config['break_date']['date_format']
     break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
@@ -213,37 +483,68 @@ def create_revenue_features(config, bank, fname_prefix):
     transaction_df = transaction_df[transaction_df[trans_cols['tran_date']] <= break_date]
     # transaction_df = transaction_df[transaction_df[trans_cols['mcc']].isin([5411])]
 
-    group = transaction_df.groupby(trans_cols['merchant_id'])
+    ids = load_id_dict(bank, fname_prefix)
+    transaction_df['merchant_code'], transaction_df['customer_code'] = trans_codes(transaction_df, ids, trans_cols)
+
+    group = transaction_df.groupby('merchant_code')
 
     revenue_sum = group.agg({trans_cols['tran_amount']: ['size', 'sum']})
     revenue_sum.columns = ['trans_count', 'total_revenue']
 
-    nunique_cust = group[[trans_cols['customer_id']]].apply(lambda x: np.unique(x).shape[0]).rename('unique_num_customers')
+    nunique_cust = group[['customer_code']].apply(lambda x: np.unique(x).shape[0]).rename('unique_num_customers')
 
-    monthly_rev = transaction_df.groupby([trans_cols['merchant_id'], 'yyyymm'])[trans_cols['tran_amount']].agg(['mean', 'std']).unstack()
+    monthly_rev = transaction_df.groupby(['merchant_code', 'yyyymm'])[trans_cols['tran_amount']].agg(['mean', 'std']).unstack()
     monthly_rev.columns = monthly_rev.columns.to_flat_index()
 
     rev = pd.concat([revenue_sum, nunique_cust, monthly_rev], axis=1)
-    logger.debug('bank {}, revenue features, # of rows: {}, # of columns: {}'.format(bank, rev.shape[0], rev.shape[1]))
-    logger.debug('bank {}, nan_values: {}'.format(bank, rev.isna().sum()))
-    rev.to_csv(output_fname)
+    rev.index = decode(rev.index, ids['merchant_ids'])
+    rev.index.name = trans_cols['merchant_id']
+    return rev
 
 
-def generate_labels(config, bank, fname_prefix):
+@perf_log.stage('create_revenue_features')
+def create_revenue_features(config, bank, fname_prefix, engine='pandas'):
     '''
-    generate merchant well-being labels based on revenu
+    create features based on revenur for the given bank type 
     '''
-    fname = f'labels_{bank}.csv'
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+    perf.meta['engine'] = engine
+
+    fname = f'revenue_{bank}.csv'
     if fname_prefix:
         fname = f'{fname_prefix}_{fname}'
-    output = join('labels', fname)
 
-    if exists(output):
-        print(f'{output} already exists')
+    output_fname = join('features', fname)
+
+    if exists(output_fname):
+        print(f'{output_fname} already exists')
         return
 
-    print('preparing labels')
+    print('extracting revenue features')
+
+    trans_fname = f'filtered_bank_{bank}_trans.csv'
+    if fname_prefix:
+        trans_fname = f'{fname_prefix}_{trans_fname}'
+    if engine == 'duckdb':
+        import duckdb_backend
+        rev = duckdb_backend.revenue_features(config, bank, fname_prefix)
+    else:
+        rev = revenue_features(config, bank, fname_prefix)
+    perf.read(join('data', 'filtered_data', trans_fname))
+
+    logger.debug('bank {}, revenue features, # of rows: {}, # of columns: {}'.format(bank, rev.shape[0], rev.shape[1]))
+    logger.debug('bank {}, nan_values: {}'.format(bank, rev.isna().sum()))
+    rev.to_csv(output_fname)
+    perf.wrote(output_fname)
+    perf.rows_out = rev.shape[0]
+
 
+def label_values(config, bank, fname_prefix):
+    '''
+    well-being labels from the change of average monthly revenues after the break date,
+    thresholded at the median change of each mcc (pandas engine)
+    '''
     trans_cols = config['tran_cols'][f'bank_{bank}']
 
     date_format = config['break_date']['date_format']
@@ -253,6 +554,9 @@ def generate_labels(config, bank, fname_prefix):
     if fname_prefix:
         agg_trans_fname = f'{fname_prefix}_{agg_trans_fname}'
     df = pd.read_csv(join('data', 'filtered_data', agg_trans_fname), index_col=[0, 1, 2], header=[0, 1])
+    perf = perf_log.current()
+    if perf is not None:
+        perf.rows_in = df.shape[0]
     
     # split transaction summaries into two halves
     df = df[trans_cols['tran_amount']].reset_index(level=2)
@@ -282,10 +586,45 @@ def generate_labels(config, bank, fname_prefix):
     revenue_change.loc[gt_median] = 1
     revenue_change.loc[ls_median] = 0
 
+    return revenue_change
+
+
+@perf_log.stage('generate_labels')
+def generate_labels(config, bank, fname_prefix, engine='pandas'):
+    '''
+    generate merchant well-being labels based on revenu
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+    perf.meta['engine'] = engine
+
+    fname = f'labels_{bank}.csv'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+    output = join('labels', fname)
+
+    if exists(output):
+        print(f'{output} already exists')
+        return
+
+    print('preparing labels')
+
+    agg_trans_fname = f'agg_bank_{bank}_trans.csv'
+    if fname_prefix:
+        agg_trans_fname = f'{fname_prefix}_{agg_trans_fname}'
+    if engine == 'duckdb':
+        import duckdb_backend
+        revenue_change = duckdb_backend.label_values(config, bank, fname_prefix)
+    else:
+        revenue_change = label_values(config, bank, fname_prefix)
+    perf.read(join('data', 'filtered_data', agg_trans_fname))
+
     logger.debug('bank {}, labels, # of rows: {}'.format(bank, revenue_change.shape[0]))
     logger.debug('bank {}, nan_values: {}'.format(bank, revenue_change.isna().sum()))
     logger.debug('bank {}, label distribution: {}'.format(bank, revenue_change.value_counts(normalize=True)))
     revenue_change.to_csv(output)
+    perf.wrote(output)
+    perf.rows_out = revenue_change.shape[0]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create revenue/demographic/network features and well-being labels')
@@ -314,6 +653,39 @@ if __name__ == '__main__':
         help='weighted network features'
     )
 
+    parser.add_argument(
+        '-T',
+        '--temporal',
+        action='store_true',
+        help='create per-window features of the temporal networks as well'
+    )
+
+    parser.add_argument(
+        '-S',
+        '--sweep',
+        type=int,
+        nargs='*',
+        required=False,
+        help='min_customer_num thresholds of the network sweep (network_conf.sweep_thresholds if empty)'
+    )
+
+    parser.add_argument(
+        '-A',
+        '--alpha',
+        type=float,
+        required=False,
+        help='significance level of the disparity filter backbone'
+    )
+
+    parser.add_argument(
+        '-E',
+        '--engine',
+        type=str,
+        choices=['pandas', 'duckdb'],
+        default='pandas',
+        help='query engine of the revenue features and labels'
+    )
+
     args = parser.parse_args()
     bank = args.bank.lower()
     fname_prefix = args.prefix
@@ -322,7 +694,15 @@ if __name__ == '__main__':
     with open(join('config.yaml')) as f:
         config = yaml.safe_load(f)
 
-    generate_labels(config, bank, fname_prefix)
+    generate_labels(config, bank, fname_prefix, engine=args.engine)
     create_demographics(config, bank, fname_prefix)
-    create_network(config, bank, fname_prefix, weights=weight)
-    create_revenue_features(config, bank, fname_prefix)
\ No newline at end of file
+    full_sec = create_network(config, bank, fname_prefix, weights=weight)
+    if args.temporal:
+        create_temporal_network(config, bank, fname_prefix, weights=weight)
+    if args.sweep is not None or args.alpha:
+        thresholds = None
+        if args.sweep is not None:
+            thresholds = args.sweep or config['network_conf']['sweep_thresholds']
+        create_network_sweep(config, bank, fname_prefix, weights=weight, thresholds=thresholds, alpha=args.alpha,
+                             full_sec=full_sec)
+    create_revenue_features(config, bank, fname_prefix, engine=args.engine)
\ No newline at end of file
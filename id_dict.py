@@ -0,0 +1,64 @@
+import pandas as pd
+import numpy as np
+from os.path import join, exists
+
+
+def id_dict_fname(bank, fname_prefix=None):
+    '''
+    id dictionary path, falls back to the master dictionary if the prefixed one does not exist
+    '''
+    fname = f'bank_{bank}_ids.npz'
+    if fname_prefix and exists(join('data', 'filtered_data', f'{fname_prefix}_{fname}')):
+        fname = f'{fname_prefix}_{fname}'
+    return join('data', 'filtered_data', fname)
+
+
+def build_id_dict(merchant_ids, customer_ids):
+    '''
+    sorted unique merchant (int) and customer (str) ids, the position of an id is its code
+    '''
+    return {'merchant_ids': np.unique(np.asarray(merchant_ids, dtype=np.int64)),
+            'customer_ids': np.unique(np.asarray(customer_ids).astype(str))}
+
+
+def save_id_dict(ids, fname):
+    '''
+    persist the id dictionary
+    '''
+    np.savez_compressed(fname, merchant_ids=ids['merchant_ids'], customer_ids=ids['customer_ids'])
+
+
+def load_id_dict(bank, fname_prefix=None):
+    '''
+    load the id dictionary of the given bank
+    '''
+    data = np.load(id_dict_fname(bank, fname_prefix))
+    return {'merchant_ids': data['merchant_ids'], 'customer_ids': data['customer_ids']}
+
+
+def encode(values, ids):
+    '''
+    dense int32 codes of the given ids, -1 for the ids that are not in the dictionary
+    '''
+    values = np.asarray(values)
+    if ids.dtype.kind == 'U':
+        values = values.astype(str)
+    return pd.Index(ids).get_indexer(values).astype(np.int32)
+
+
+def decode(codes, ids):
+    '''
+    original ids of the given codes
+    '''
+    return ids[np.asarray(codes)]
+
+
+def trans_codes(trans_df, ids, trans_cols):
+    '''
+    merchant and customer codes of the transactions, read from the code columns written by
+    filter_records.py when available
+    '''
+    if 'merchant_code' in trans_df and 'customer_code' in trans_df:
+        return trans_df['merchant_code'].to_numpy(), trans_df['customer_code'].to_numpy()
+    return (encode(trans_df[trans_cols['merchant_id']], ids['merchant_ids']),
+            encode(trans_df[trans_cols['customer_id']], ids['customer_ids']))
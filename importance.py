@@ -0,0 +1,111 @@
+import pandas as pd
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.metrics import roc_auc_score
+import perf_log
+
+
+def feature_groups(columns):
+    '''
+    column positions of every feature file, grouped by the '{file stem}__' prefix of load_data
+    '''
+    groups = {}
+    for i, col in enumerate(columns):
+        groups.setdefault(col.split('__')[0], []).append(i)
+    return groups
+
+
+def batched_aucs(model, X_blocks, y):
+    '''
+    test aucs of the stacked copies of a test fold, predicted in one call
+    '''
+    n = len(y)
+    proba = model.predict_proba(np.vstack(X_blocks))[:, 1]
+    return np.array([roc_auc_score(y, proba[i * n:(i + 1) * n]) for i in range(len(X_blocks))])
+
+
+def _permutation_task(fold, model, X, y, feature_batch, n_repeats, seed):
+    '''
+    auc drops of the given features in one fold, every stacked copy permutes a single column.
+    every (fold, feature) has its own random stream, so the drops do not depend on the batching.
+    '''
+    rngs = [np.random.default_rng([seed, fold, j]) for j in feature_batch]
+    base_auc = roc_auc_score(y, model.predict_proba(X)[:, 1])
+    drops = np.zeros((len(feature_batch), n_repeats))
+    for r in range(n_repeats):
+        blocks = []
+        for j, rng in zip(feature_batch, rngs):
+            X_perm = X.copy()
+            X_perm[:, j] = X[rng.permutation(X.shape[0]), j]
+            blocks.append(X_perm)
+        drops[:, r] = base_auc - batched_aucs(model, blocks, y)
+    return fold, feature_batch, drops
+
+
+def _ablation_task(fold, model, X, y, groups):
+    '''
+    auc drops in one fold when all columns of a group are set to their training mean
+    (0 after scaling), so the fitted model gets no information from the group
+    '''
+    base_auc = roc_auc_score(y, model.predict_proba(X)[:, 1])
+    blocks = []
+    for positions in groups.values():
+        X_abl = X.copy()
+        X_abl[:, positions] = 0.0
+        blocks.append(X_abl)
+    return fold, base_auc - batched_aucs(model, blocks, y)
+
+
+def permutation_importance(folds, columns, n_repeats=5, n_jobs=-1, batch_cells=2**22, seed=1):
+    '''
+    mean/std test auc drop over the outer folds and repeats when a feature column is permuted.
+    folds are the (fitted model, scaled test features, test labels) of run_cross_validation,
+    tasks are (fold, feature batch) pairs and a batch is predicted as one stacked matrix.
+    a stacked matrix has at most batch_cells (rows x columns) values, a task holds about two
+    of them (32 MB each by default) and n_jobs tasks run at once.
+    '''
+    tasks = []
+    for fold, (model, X, y) in enumerate(folds):
+        batch_size = max(1, batch_cells // X.size)
+        for start in range(0, len(columns), batch_size):
+            feature_batch = list(range(start, min(start + batch_size, len(columns))))
+            tasks.append(delayed(_permutation_task)(fold, model, X, y, feature_batch, n_repeats, seed))
+
+    drops = np.zeros((len(columns), len(folds), n_repeats))
+    for fold, feature_batch, batch_drops in Parallel(n_jobs=n_jobs)(tasks):
+        drops[feature_batch, fold] = batch_drops
+    drops = drops.reshape(len(columns), -1)
+
+    return pd.DataFrame({'pimp_mean': drops.mean(axis=1), 'pimp_std': drops.std(axis=1, ddof=1)}, index=columns)
+
+
+def group_ablation(folds, columns, n_jobs=-1):
+    '''
+    mean/std test auc drop over the outer folds when the columns of a feature file are ablated
+    '''
+    groups = feature_groups(columns)
+    tasks = [delayed(_ablation_task)(fold, model, X, y, groups) for fold, (model, X, y) in enumerate(folds)]
+
+    drops = np.zeros((len(groups), len(folds)))
+    for fold, fold_drops in Parallel(n_jobs=n_jobs)(tasks):
+        drops[:, fold] = fold_drops
+
+    return pd.DataFrame({'auc_drop_mean': drops.mean(axis=1),
+                         'auc_drop_std': drops.std(axis=1, ddof=1),
+                         'n_features': [len(positions) for positions in groups.values()]},
+                        index=pd.Index(list(groups), name='group'))
+
+
+def importance_tables(fold_dict, columns, n_repeats=5, n_jobs=-1, batch_cells=2**22):
+    '''
+    permutation importance and group ablation tables of every classifier
+    '''
+    tables = {}
+    for clf_name, folds in fold_dict.items():
+        with perf_log.stage(f'importance_{clf_name}', n_jobs=n_jobs) as step:
+            step.rows_in = sum(X.shape[0] for _, X, _ in folds)
+            tables[clf_name] = (permutation_importance(folds, columns, n_repeats=n_repeats, n_jobs=n_jobs,
+                                                       batch_cells=batch_cells),
+                                group_ablation(folds, columns, n_jobs=n_jobs))
+            step.rows_out = len(columns)
+    return tables
@@ -0,0 +1,270 @@
+import pandas as pd
+import numpy as np
+from os.path import join, exists
+import os
+import argparse
+import yaml
+import igraph as ig
+from multiprocessing import Pool
+from gensim.models import Word2Vec
+from gensim.models.word2vec import PathLineSentences
+from tqdm import tqdm
+import logging
+import perf_log
+from construct_network import network_fname, network_id_dict
+from id_dict import decode
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.FileHandler('.embedlogfile', 'a')
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# walk state shared with the pool workers
+_graph = {}
+
+
+def graph_to_csr(g, weights='weight'):
+    '''
+    symmetric csr adjacency (indptr, indices, weights) of an undirected igraph graph.
+    neighbors are sorted within each row.
+    '''
+    n = g.vcount()
+    edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    if weights and weights in g.es.attributes():
+        w = np.array(g.es[weights], dtype=np.float64)
+    else:
+        w = np.ones(edges.shape[0], dtype=np.float64)
+
+    src = np.concatenate([edges[:, 0], edges[:, 1]])
+    dst = np.concatenate([edges[:, 1], edges[:, 0]])
+    w = np.concatenate([w, w])
+    order = np.lexsort((dst, src))
+    src, dst, w = src[order], dst[order], w[order]
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst, w
+
+
+def build_alias_tables(indptr, weights):
+    '''
+    vose alias tables for every row of the csr adjacency.
+    alias entries are offsets within the row, so a draw is indptr[v] + offset.
+    '''
+    prob = np.zeros(weights.shape[0], dtype=np.float64)
+    alias = np.zeros(weights.shape[0], dtype=np.int64)
+    for v in range(len(indptr) - 1):
+        start, end = indptr[v], indptr[v + 1]
+        deg = end - start
+        if deg == 0:
+            continue
+        scaled = weights[start:end] * deg / weights[start:end].sum()
+        row_prob = np.ones(deg, dtype=np.float64)
+        row_alias = np.arange(deg, dtype=np.int64)
+        small = [i for i in range(deg) if scaled[i] < 1.0]
+        large = [i for i in range(deg) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            row_prob[s] = scaled[s]
+            row_alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        prob[start:end] = row_prob
+        alias[start:end] = row_alias
+    return prob, alias
+
+
+def _init_worker(indptr, indices, prob, alias, p, q):
+    n = len(indptr) - 1
+    # sorted (row * n + col) keys for vectorized edge lookups
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    _graph.update(indptr=indptr, indices=indices, prob=prob, alias=alias, p=p, q=q,
+                  n=n, edge_keys=rows * n + indices)
+
+
+def _draw_neighbors(nodes, rng):
+    '''
+    vectorized first-order (weighted) neighbor draws from the alias tables
+    '''
+    indptr, prob, alias = _graph['indptr'], _graph['prob'], _graph['alias']
+    start = indptr[nodes]
+    deg = indptr[nodes + 1] - start
+    k = start + (rng.random(len(nodes)) * deg).astype(np.int64)
+    use_alias = rng.random(len(nodes)) >= prob[k]
+    k[use_alias] = start[use_alias] + alias[k[use_alias]]
+    return _graph['indices'][k]
+
+
+def _biased_step(prev, cur, rng):
+    '''
+    second-order node2vec step with (p, q) bias via rejection sampling on top of the alias draws
+    '''
+    p, q, n, edge_keys = _graph['p'], _graph['q'], _graph['n'], _graph['edge_keys']
+    max_bias = max(1.0 / p, 1.0, 1.0 / q)
+    nxt = np.empty(len(cur), dtype=np.int64)
+    pending = np.arange(len(cur))
+    while len(pending) > 0:
+        cand = _draw_neighbors(cur[pending], rng)
+        t = prev[pending]
+        keys = t * n + cand
+        pos = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+        bias = np.where(cand == t, 1.0 / p, np.where(edge_keys[pos] == keys, 1.0, 1.0 / q))
+        accepted = rng.random(len(pending)) * max_bias < bias
+        nxt[pending[accepted]] = cand[accepted]
+        pending = pending[~accepted]
+    return nxt
+
+
+def _generate_walks(task):
+    '''
+    generate the walks of one task and stream them into its own corpus file
+    '''
+    start_nodes, walk_length, batch_size, seed, output_fname = task
+    rng = np.random.default_rng(seed)
+    indptr = _graph['indptr']
+    n_walks = 0
+    with open(output_fname, 'w') as f:
+        for b in range(0, len(start_nodes), batch_size):
+            walks = np.full((min(batch_size, len(start_nodes) - b), walk_length), -1, dtype=np.int64)
+            walks[:, 0] = start_nodes[b:b + batch_size]
+            alive = indptr[walks[:, 0] + 1] > indptr[walks[:, 0]]
+            for step in range(1, walk_length):
+                rows = np.where(alive)[0]
+                if len(rows) == 0:
+                    break
+                cur = walks[rows, step - 1]
+                if step == 1:
+                    walks[rows, step] = _draw_neighbors(cur, rng)
+                else:
+                    walks[rows, step] = _biased_step(walks[rows, step - 2], cur, rng)
+            walks = walks[alive]
+            f.writelines(' '.join(map(str, walk[walk >= 0])) + '\n' for walk in walks)
+            n_walks += walks.shape[0]
+    return n_walks
+
+
+@perf_log.stage('create_node2vec_features')
+def create_node2vec_features(config, bank, fname_prefix, weights='weight'):
+    '''
+    learn node2vec embeddings of merchants from weighted, (p, q) biased random walks
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
+    fname = f'node2vec_{bank}.csv'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+    output_fname = join('features', fname)
+
+    if exists(output_fname):
+        print(f'{output_fname} already exists')
+        return
+
+    print('extracting node2vec features')
+
+    n2v_conf = config['node2vec_conf']
+
+    net_fname = network_fname(bank, fname_prefix)
+    g = ig.Graph.Read_Pickle(net_fname)
+    perf.read(net_fname)
+    perf.rows_in = g.ecount()
+
+    with perf_log.stage('alias_tables') as step:
+        indptr, indices, edge_weights = graph_to_csr(g, weights)
+        prob, alias = build_alias_tables(indptr, edge_weights)
+        step.rows_in = len(indices)
+
+    walk_dir = join('data', 'walks', f'{fname_prefix}_bank_{bank}' if fname_prefix else f'bank_{bank}')
+    os.makedirs(walk_dir, exist_ok=True)
+    for old_fname in os.listdir(walk_dir):
+        os.remove(join(walk_dir, old_fname))
+
+    # one task per (walk repetition, worker chunk) so each task streams into its own file
+    workers = n2v_conf['workers']
+    rng = np.random.default_rng(n2v_conf['seed'])
+    tasks = []
+    for r in range(n2v_conf['num_walks']):
+        nodes = rng.permutation(g.vcount())
+        for c, chunk in enumerate(np.array_split(nodes, workers)):
+            tasks.append((chunk, n2v_conf['walk_length'], n2v_conf['batch_size'], rng.integers(2**31),
+                          join(walk_dir, f'walks_{r:03d}_{c:03d}.txt')))
+
+    with perf_log.stage('random_walks', workers=workers) as step:
+        with Pool(workers, initializer=_init_worker,
+                  initargs=(indptr, indices, prob, alias, n2v_conf['p'], n2v_conf['q'])) as pool:
+            n_walks = sum(tqdm(pool.imap_unordered(_generate_walks, tasks), total=len(tasks), desc='random walks'))
+        step.rows_out = n_walks
+        for walk_fname in os.listdir(walk_dir):
+            step.wrote(join(walk_dir, walk_fname))
+
+    with perf_log.stage('skip_gram') as step:
+        model = Word2Vec(PathLineSentences(walk_dir),
+                         vector_size=n2v_conf['dimensions'],
+                         window=n2v_conf['window'],
+                         min_count=0,
+                         sg=1,
+                         workers=workers,
+                         epochs=n2v_conf['epochs'],
+                         seed=n2v_conf['seed'])
+        step.rows_out = len(model.wv)
+
+    # isolated merchants never appear in a walk, they get all-zero embeddings
+    emb = np.zeros((g.vcount(), n2v_conf['dimensions']), dtype=np.float32)
+    vocab = np.array([int(token) for token in model.wv.index_to_key], dtype=np.int64)
+    emb[vocab] = model.wv.vectors
+
+    # vertex indices are merchant codes
+    ids = network_id_dict(bank, fname_prefix)
+    emb_df = pd.DataFrame(emb, index=decode(np.arange(g.vcount()), ids['merchant_ids']))
+    emb_df.index.name = 'merchant_id'
+
+    logger.debug('bank {}, node2vec features, # of rows: {}, # of columns: {}, isolated merchants: {}'.format(
+        bank, emb_df.shape[0], emb_df.shape[1], g.vcount() - len(vocab)))
+    logger.debug('bank {}, # of walks: {}, walk corpus: {}'.format(bank, n_walks, walk_dir))
+
+    emb_df.to_csv(output_fname)
+    perf.wrote(output_fname)
+    perf.rows_out = emb_df.shape[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create node2vec embedding features of merchant networks')
+
+    parser.add_argument(
+        '-B',
+        '--bank',
+        type=str,
+        required=True,
+        help='bank name ("x", "y" or custom)'
+    )
+
+    parser.add_argument(
+        '-P',
+        '--prefix',
+        type=str,
+        required=False,
+        help='output file name prefix'
+    )
+
+    parser.add_argument(
+        '-W',
+        '--weight',
+        type=str,
+        default='weight',
+        help='edge attribute used as walk transition weights'
+    )
+
+    args = parser.parse_args()
+    bank = args.bank.lower()
+
+    with open(join('config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    create_node2vec_features(config, bank, args.prefix, weights=args.weight)
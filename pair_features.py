@@ -0,0 +1,259 @@
+import pandas as pd
+import numpy as np
+from os.path import join, exists
+import argparse
+import yaml
+from datetime import datetime
+import igraph as ig
+import logging
+import perf_log
+from construct_network import network_fname, network_id_dict
+from id_dict import decode
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.FileHandler('.pairlogfile', 'a')
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# (quartile column, value column) pairs
+QUARTILE_COLS = [('revenue_quartile', 'period_revenue'),
+                 ('transaction_quartile', 'period_transaction_count'),
+                 ('customer_count_quartile', 'period_distinct_customers')]
+
+CHANGE_COLS = ['revenue_change', 'transaction_change', 'customer_change']
+
+# (difference column, value column) pairs
+DIFFERENCE_COLS = [('difference_in_period_revenue', 'period_revenue'),
+                   ('difference_in_period_transaction', 'period_transaction_count'),
+                   ('difference_in_period_customers', 'period_distinct_customers')]
+
+SLOPE_COLS = ['revenue_slope', 'transaction_slope', 'customer_slope']
+
+
+def monthly_slopes(config, bank, agg_fname):
+    '''
+    least squares slopes of the monthly revenue, transaction count and distinct customer totals of
+    every merchant over the months up to the break date, from the daily aggregate summaries.
+    months without transactions count as 0.
+    '''
+    trans_cols = config['tran_cols'][f'bank_{bank}']
+    date_format = config['break_date']['date_format']
+    break_date = datetime.strptime(config['break_date'][f'bank_{bank}'], date_format)
+
+    agg_df = pd.read_csv(agg_fname, index_col=[0, 1, 2], header=[0, 1])
+    df = pd.DataFrame({'merchant_id': agg_df.index.get_level_values(0),
+                       'tran_date': pd.to_datetime(agg_df.index.get_level_values(2), format=date_format),
+                       'revenue_slope': agg_df[(trans_cols['tran_amount'], 'sum')].to_numpy(),
+                       'transaction_slope': agg_df[(trans_cols['customer_id'], 'count')].to_numpy(),
+                       'customer_slope': agg_df[(trans_cols['customer_id'], 'nunique')].to_numpy()})
+    df = df[df['tran_date'] <= break_date]
+    df['month'] = df['tran_date'].dt.year * 12 + df['tran_date'].dt.month
+
+    monthly = df.groupby(['merchant_id', 'month'])[SLOPE_COLS].sum()
+    months = np.arange(monthly.index.get_level_values(1).min(), monthly.index.get_level_values(1).max() + 1)
+    x = months - months.mean()
+    slopes = {}
+    for col in SLOPE_COLS:
+        y = monthly[col].unstack(fill_value=0).reindex(columns=months, fill_value=0).to_numpy(dtype=np.float64)
+        slopes[col] = y @ x / (x @ x)
+    return pd.DataFrame(slopes, index=monthly.index.get_level_values(0).unique())
+
+
+def load_edges(g, ids):
+    '''
+    returns the (merchant_id_1, merchant_id_2) arrays of the graph edges
+    '''
+    edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    return decode(edges[:, 0], ids['merchant_ids']), decode(edges[:, 1], ids['merchant_ids'])
+
+
+def quartile_labels(s):
+    '''
+    global quartile (Q1-Q4) of every value in the series, quartile bins are closed on the left
+    '''
+    bounds = s.quantile([0.25, 0.5, 0.75]).to_numpy()
+    codes = np.searchsorted(bounds, s.to_numpy(), side='right')
+    return np.array(['Q1', 'Q2', 'Q3', 'Q4'])[codes]
+
+
+def pair_chunk(attr, i1, i2, pair_conf):
+    '''
+    pair indicator table of the given endpoint row positions in the attribute table
+    '''
+    out = {}
+    for col in ['merchant_id', 'mcc', 'district_id', 'performance_label']:
+        out[f'{col}_1'] = attr[col].take(i1)
+        out[f'{col}_2'] = attr[col].take(i2)
+    for q_col, v_col in QUARTILE_COLS:
+        out[f'{q_col}_1'] = attr[q_col].take(i1)
+        out[f'{q_col}_2'] = attr[q_col].take(i2)
+        out[f'{v_col}_1'] = attr[v_col].take(i1)
+        out[f'{v_col}_2'] = attr[v_col].take(i2)
+    for col in CHANGE_COLS:
+        out[f'{col}_1'] = attr[col].take(i1)
+        out[f'{col}_2'] = attr[col].take(i2)
+    for d_col, v_col in DIFFERENCE_COLS:
+        v1, v2 = out[f'{v_col}_1'], out[f'{v_col}_2']
+        out[d_col] = np.abs(v1 - v2) / (v1 + v2)
+
+    slope_cols = [col for col in SLOPE_COLS if col in attr]
+    for col in slope_cols:
+        out[f'{col}_1'] = attr[col].take(i1)
+    for col in slope_cols:
+        out[f'{col}_2'] = attr[col].take(i2)
+
+    # indicator: the better performing merchant of the pair has the steeper slope
+    first_better = out['performance_label_1'] == pair_conf['positive_label']
+    indicators = []
+    for col in slope_cols[::-1]:
+        s1, s2 = out[f'{col}_1'], out[f'{col}_2']
+        test = np.where(first_better, s1 > s2, s2 > s1).astype(int)
+        # merchants without monthly aggregates have no slope
+        unknown = np.isnan(s1.astype(float)) | np.isnan(s2.astype(float))
+        out[f'{col}_test'] = np.where(unknown, np.nan, test) if unknown.any() else test
+        indicators.append(out[f'{col}_test'])
+    if indicators:
+        out['sum_indicator'] = np.sum(indicators, axis=0)
+
+    return pd.DataFrame(out)
+
+
+@perf_log.stage('create_pair_indicators')
+def create_pair_indicators(config, bank, fname_prefix, attr_fname, agg_fname=None):
+    '''
+    creates merchant-pair indicators for the edges of the merchant network. slopes that are not
+    in the attribute table are derived from the daily aggregate summaries (agg_fname).
+    '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
+    fname = f'label_indicators_{bank}.csv'
+    if fname_prefix:
+        fname = f'{fname_prefix}_{fname}'
+    output_fname = join('labels', fname)
+
+    if exists(output_fname):
+        print(f'{output_fname} already exists')
+        return
+
+    print('extracting merchant pair indicators')
+
+    pair_conf = config['pair_conf']
+
+    net_fname = network_fname(bank, fname_prefix)
+    g = ig.Graph.Read_Pickle(net_fname)
+    perf.read(net_fname)
+    mid_1, mid_2 = load_edges(g, network_id_dict(bank, fname_prefix))
+    perf.rows_in = len(mid_1)
+
+    attr_df = pd.read_csv(attr_fname)
+    perf.read(attr_fname)
+    if 'period' in attr_df:
+        attr_df = attr_df[attr_df['period'] == pair_conf['period']]
+    attr_df = attr_df.reset_index(drop=True)
+
+    for q_col, v_col in QUARTILE_COLS:
+        attr_df[q_col] = quartile_labels(attr_df[v_col])
+
+    missing_slopes = [col for col in SLOPE_COLS if col not in attr_df]
+    if missing_slopes:
+        if agg_fname is None:
+            agg_fname = f'agg_bank_{bank}_trans.csv'
+            if fname_prefix:
+                agg_fname = f'{fname_prefix}_{agg_fname}'
+            agg_fname = join('data', 'filtered_data', agg_fname)
+        assert exists(agg_fname), \
+            f'{attr_fname} has no {missing_slopes} columns and there are no aggregate summaries ({agg_fname}) to derive them'
+        slope_df = monthly_slopes(config, bank, agg_fname)
+        perf.read(agg_fname)
+        n_known = attr_df['merchant_id'].isin(slope_df.index).sum()
+        assert n_known > 0, f'none of the merchants of {attr_fname} are in {agg_fname}'
+        if n_known < attr_df.shape[0]:
+            print(f'{attr_df.shape[0] - n_known} merchants have no monthly aggregates, their slope indicators are empty')
+        logger.debug('bank {}, {} derived from {}, merchants without aggregates: {}'.format(
+            bank, missing_slopes, agg_fname, attr_df.shape[0] - n_known))
+        for col in missing_slopes:
+            attr_df[col] = slope_df[col].reindex(attr_df['merchant_id']).to_numpy()
+
+    # endpoint row positions, merchant_id_1 < merchant_id_2
+    lo, hi = np.minimum(mid_1, mid_2), np.maximum(mid_1, mid_2)
+    mid_index = pd.Index(attr_df['merchant_id'])
+    i1, i2 = mid_index.get_indexer(lo), mid_index.get_indexer(hi)
+    known = (i1 >= 0) & (i2 >= 0)
+    logger.debug('bank {}, edges without merchant attributes: {}'.format(bank, (~known).sum()))
+    i1, i2 = i1[known], i2[known]
+
+    attr = {col: attr_df[col].to_numpy() for col in attr_df.columns}
+
+    keep = np.ones(len(i1), dtype=bool)
+    if pair_conf['same_mcc']:
+        keep &= attr['mcc'].take(i1) == attr['mcc'].take(i2)
+    if pair_conf['opposite_labels']:
+        l1, l2 = attr['performance_label'].take(i1), attr['performance_label'].take(i2)
+        keep &= ((l1 == pair_conf['positive_label']) & (l2 == pair_conf['negative_label'])) | \
+                ((l1 == pair_conf['negative_label']) & (l2 == pair_conf['positive_label']))
+    i1, i2 = i1[keep], i2[keep]
+
+    # keep the pairs ordered by merchant ids
+    order = np.lexsort((attr['merchant_id'].take(i2), attr['merchant_id'].take(i1)))
+    i1, i2 = i1[order], i2[order]
+
+    chunk_size = pair_conf['chunk_size']
+    header = True
+    for start in range(0, len(i1), chunk_size):
+        chunk_df = pair_chunk(attr, i1[start:start + chunk_size], i2[start:start + chunk_size], pair_conf)
+        chunk_df.to_csv(output_fname, header=header, index=False, mode='a')
+        header = False
+
+    logger.debug('bank {}, pair indicators, # of edges: {}, # of pairs: {}'.format(bank, len(mid_1), len(i1)))
+
+    perf.wrote(output_fname)
+    perf.rows_out = len(i1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create merchant pair indicators for the merchant network edges')
+
+    parser.add_argument(
+        '-B',
+        '--bank',
+        type=str,
+        required=True,
+        help='bank name ("x", "y" or custom)'
+    )
+
+    parser.add_argument(
+        '-P',
+        '--prefix',
+        type=str,
+        required=False,
+        help='output file name prefix'
+    )
+
+    parser.add_argument(
+        '-A',
+        '--attributes',
+        type=str,
+        default=join('Data', 'Pre-processed', 'all_merchants_attributes_and_labels.csv'),
+        help='merchant attribute and label table'
+    )
+
+    parser.add_argument(
+        '-G',
+        '--aggregates',
+        type=str,
+        required=False,
+        help='daily aggregate summaries the missing slopes are derived from (data/filtered_data/agg_bank_[type]_trans.csv if not given)'
+    )
+
+    args = parser.parse_args()
+    bank = args.bank.lower()
+
+    with open(join('config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    create_pair_indicators(config, bank, args.prefix, args.attributes, args.aggregates)
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import argparse
+from os.path import basename, exists, getsize
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+import pandas as pd
+
+
+PERF_LOG = '.perflog.jsonl'
+
+# share a single run id across the scripts of one pipeline run with
+# `set PERF_RUN_ID=...` (see exp_batch.bat), otherwise every process gets its own
+RUN_ID = os.environ.get('PERF_RUN_ID') or '{}-{}'.format(datetime.now().strftime('%Y%m%d%H%M%S'), os.getpid())
+
+_active = []
+
+
+class StageRecord:
+    '''
+    measurements of a single pipeline stage (or sub-step)
+    '''
+    def __init__(self, name, meta):
+        self.name = name
+        self.meta = meta
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, path):
+        '''
+        account for a file read by this stage
+        '''
+        if exists(path):
+            self.bytes_read += getsize(path)
+
+    def wrote(self, path):
+        '''
+        account for a file written by this stage
+        '''
+        if exists(path):
+            self.bytes_written += getsize(path)
+
+
+def peak_rss_mb():
+    '''
+    peak resident set size of the current process in MB (None if it cannot be measured)
+    '''
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports KB, macos reports bytes
+        return maxrss / 1024.0 ** 2 if sys.platform == 'darwin' else maxrss / 1024.0
+    try:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss) / 1024.0 ** 2
+    except ImportError:
+        return None
+
+
+def current():
+    '''
+    returns the innermost active stage record
+    '''
+    return _active[-1] if _active else None
+
+
+@contextmanager
+def stage(name, **meta):
+    '''
+    measure wall time, cpu time and memory of a stage and append the record to the perf log.
+    process_peak_rss_mb is the peak of the whole process so far, rss_growth_mb is how much the
+    stage raised that peak (0 when an earlier stage already used more memory).
+    nested stages are recorded as `parent/child`. can be used as a decorator as well.
+    '''
+    if _active:
+        name = '{}/{}'.format(_active[-1].name, name)
+    record = StageRecord(name, meta)
+    _active.append(record)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    rss_start = peak_rss_mb()
+    try:
+        yield record
+    finally:
+        _active.pop()
+        rss_end = peak_rss_mb()
+        entry = {
+            'run_id': RUN_ID,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'script': basename(sys.argv[0]),
+            'stage': record.name,
+            'wall_sec': round(time.perf_counter() - wall_start, 4),
+            'cpu_sec': round(time.process_time() - cpu_start, 4),
+            'process_peak_rss_mb': rss_end,
+            'rss_growth_mb': rss_end - rss_start if rss_end is not None else None,
+            'rows_in': record.rows_in,
+            'rows_out': record.rows_out,
+            'bytes_read': record.bytes_read,
+            'bytes_written': record.bytes_written,
+        }
+        entry.update(record.meta)
+        with open(PERF_LOG, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+
+
+def load_log(log_fname=PERF_LOG):
+    '''
+    read the perf log into a dataframe
+    '''
+    assert exists(log_fname), f'{log_fname} does not exist'
+    with open(log_fname) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    for col in ['process_peak_rss_mb', 'rss_growth_mb']:
+        df[col] = df[col].astype(float) if col in df.columns else float('nan')
+    # older records only have the process-wide peak, as peak_rss_mb
+    if 'peak_rss_mb' in df.columns:
+        df['process_peak_rss_mb'] = df['process_peak_rss_mb'].fillna(df.pop('peak_rss_mb').astype(float))
+    return df
+
+
+def summarize(log_fname=PERF_LOG, top=10, last_runs=5):
+    '''
+    slowest steps by their latest run and their wall time trend. every (script, stage) is
+    compared over the last runs that contain it, so scripts can run in separate processes.
+    '''
+    df = load_log(log_fname)
+    keys = ['script', 'stage']
+    df['run_start'] = df['run_id'].map(df.groupby('run_id')['timestamp'].min())
+
+    # a stage can run several times in a run (e.g. one call per bank)
+    runs = df.groupby(keys + ['run_start', 'run_id']).agg(
+        wall_sec=('wall_sec', 'sum'), cpu_sec=('cpu_sec', 'sum'),
+        process_peak_rss_mb=('process_peak_rss_mb', 'max'), rss_growth_mb=('rss_growth_mb', 'max')).reset_index()
+    runs = runs.sort_values(keys + ['run_start']).groupby(keys).tail(last_runs)
+    # 0 is the latest run of the stage, 1 the one before, ...
+    runs['age'] = runs.groupby(keys).cumcount(ascending=False)
+
+    latest = runs[runs['age'] == 0].set_index(keys)
+    summary = latest[['run_id', 'wall_sec', 'cpu_sec', 'process_peak_rss_mb', 'rss_growth_mb']]
+    summary = summary.sort_values('wall_sec', ascending=False).head(top)
+    previous = runs[runs['age'] > 0].groupby(keys)['wall_sec'].mean()
+    summary = summary.assign(prev_mean_wall_sec=previous.reindex(summary.index))
+    summary['change_pct'] = (summary['wall_sec'] - summary['prev_mean_wall_sec']) / summary['prev_mean_wall_sec'] * 100
+
+    trend = runs.set_index(keys + ['age'])['wall_sec'].unstack().reindex(summary.index)
+    trend = trend[sorted(trend.columns, reverse=True)]
+    trend.columns = ['latest' if age == 0 else f'latest-{age}' for age in trend.columns]
+    return summary, trend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize pipeline performance logs')
+
+    parser.add_argument(
+        '-T',
+        '--top',
+        type=int,
+        default=10,
+        help='number of slowest steps to show'
+    )
+
+    parser.add_argument(
+        '-R',
+        '--runs',
+        type=int,
+        default=5,
+        help='number of most recent runs used for trends'
+    )
+
+    parser.add_argument(
+        '-I',
+        '--input',
+        type=str,
+        default=PERF_LOG,
+        help='perf log file path'
+    )
+
+    args = parser.parse_args()
+
+    summary, trend = summarize(args.input, top=args.top, last_runs=args.runs)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print('slowest steps, by their latest run')
+        print(summary.round(3))
+        print()
+        print('wall time (sec) over the last runs of every step')
+        print(trend.round(3))
@@ -0,0 +1,318 @@
+import pandas as pd
+from os.path import join, basename, exists
+import argparse
+import json
+import hashlib
+import socket
+import sqlite3
+import time
+from datetime import datetime
+import perf_log
+
+
+RESULTS_DB = 'results.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    perf_run_id TEXT,
+    created_at TEXT NOT NULL,
+    host TEXT,
+    expname TEXT,
+    bank TEXT,
+    prefix TEXT,
+    label TEXT NOT NULL,
+    feature_set TEXT NOT NULL,
+    feature_files TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    n_merchants INTEGER,
+    n_features INTEGER,
+    config TEXT
+);
+CREATE TABLE IF NOT EXISTS fold_auc (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    clf TEXT NOT NULL,
+    fold INTEGER NOT NULL,
+    auc REAL,
+    search_sec REAL,
+    best_params TEXT,
+    PRIMARY KEY (run_id, clf, fold)
+);
+CREATE TABLE IF NOT EXISTS summary (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    clf TEXT NOT NULL,
+    auc_mean REAL,
+    auc_std REAL,
+    search_sec REAL,
+    n_candidates INTEGER,
+    PRIMARY KEY (run_id, clf)
+);
+CREATE TABLE IF NOT EXISTS importances (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    clf TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    mean REAL,
+    std REAL,
+    PRIMARY KEY (run_id, clf, kind, feature)
+);
+CREATE INDEX IF NOT EXISTS runs_bank_feature_set ON runs (bank, feature_set);
+CREATE INDEX IF NOT EXISTS runs_expname ON runs (expname, bank);
+CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (fingerprint);
+CREATE INDEX IF NOT EXISTS summary_clf_auc ON summary (clf, auc_mean DESC);
+CREATE INDEX IF NOT EXISTS importances_kind_feature ON importances (kind, feature, clf);
+'''
+
+
+def connect(db_fname, timeout=60.0):
+    '''
+    connection to the results store. wal lets readers work while a run is appended and the
+    busy timeout makes parallel writers wait for each other instead of failing.
+    '''
+    con = sqlite3.connect(db_fname, timeout=timeout, isolation_level=None)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute(f'PRAGMA busy_timeout={int(timeout * 1000)}')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.executescript(SCHEMA)
+    return con
+
+
+def label_info(label_filepath):
+    '''
+    (prefix, bank) of a labels file name, e.g. only_5411_labels_x.csv -> (only_5411, x)
+    '''
+    stem = basename(label_filepath).split('.')[0]
+    prefix, _, bank = stem.rpartition('labels_')
+    return prefix.rstrip('_') or None, bank
+
+
+def feature_set_name(feature_filepath_list, bank, prefix=None):
+    '''
+    bank and subset independent name of a feature set, e.g. demographics+revenue
+    '''
+    names = []
+    for filepath in feature_filepath_list:
+        name = basename(filepath).split('.')[0]
+        if prefix and name.startswith(f'{prefix}_'):
+            name = name[len(prefix) + 1:]
+        if name.endswith(f'_{bank}'):
+            name = name[:-len(bank) - 1]
+        names.append(name)
+    return '+'.join(sorted(names))
+
+
+def fingerprint(columns, filepath_list):
+    '''
+    hash of the feature columns and the contents of the label and feature files
+    '''
+    h = hashlib.sha1()
+    h.update('\n'.join(columns).encode())
+    for filepath in filepath_list:
+        h.update(basename(filepath).encode())
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def importance_rows(run_id, clf_name, kind, df):
+    return [(run_id, clf_name, kind, str(feature), float(row.iloc[0]), float(row.iloc[1]))
+            for feature, row in df.iterrows()]
+
+
+def record_run(db_fname, label_filepath, feature_filepath_list, columns, n_merchants, eval_df, search_dict,
+               importance_dict, expname=None, config=None):
+    '''
+    append one experiment run to the results store in a single immediate transaction.
+    importance_dict maps a kind (fimp, pimp, gabl) to {clf: (mean, std) table}.
+    '''
+    prefix, bank = label_info(label_filepath)
+    run = (perf_log.RUN_ID, datetime.now().isoformat(timespec='seconds'), socket.gethostname(), expname, bank, prefix,
+           basename(label_filepath), feature_set_name(feature_filepath_list, bank, prefix),
+           json.dumps([basename(f) for f in feature_filepath_list]),
+           fingerprint(columns, [label_filepath] + feature_filepath_list),
+           n_merchants, len(columns), json.dumps(config, default=str))
+
+    fold_aucs = eval_df.drop(['mean', 'std'])
+    con = connect(db_fname)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        run_id = con.execute('''
+            INSERT INTO runs (perf_run_id, created_at, host, expname, bank, prefix, label, feature_set,
+                              feature_files, fingerprint, n_merchants, n_features, config)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', run).lastrowid
+        for clf_name in eval_df.columns:
+            searches = search_dict[clf_name]
+            con.executemany('INSERT INTO fold_auc VALUES (?, ?, ?, ?, ?, ?)',
+                            [(run_id, clf_name, fold, float(auc), s['search_sec'], json.dumps(s['best_params']))
+                             for (fold, auc), s in zip(fold_aucs[clf_name].items(), searches)])
+            con.execute('INSERT INTO summary VALUES (?, ?, ?, ?, ?, ?)',
+                        (run_id, clf_name, float(eval_df.loc['mean', clf_name]), float(eval_df.loc['std', clf_name]),
+                         sum(s['search_sec'] for s in searches), searches[0]['n_candidates']))
+        for kind, tables in importance_dict.items():
+            for clf_name, df in tables.items():
+                con.executemany('INSERT INTO importances VALUES (?, ?, ?, ?, ?, ?)',
+                                importance_rows(run_id, clf_name, kind, df))
+        con.execute('COMMIT')
+    except BaseException:
+        if con.in_transaction:
+            con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+    return run_id
+
+
+def _where(filters):
+    clauses = [f'{col} = ?' for col, value in filters.items() if value is not None]
+    return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', [v for v in filters.values() if v is not None]
+
+
+def leaderboard(db_fname, bank=None, clf=None, expname=None, top=20):
+    '''
+    best runs by mean test auc
+    '''
+    where, params = _where({'r.bank': bank, 's.clf': clf, 'r.expname': expname})
+    con = connect(db_fname)
+    try:
+        return pd.read_sql_query(f'''
+            SELECT r.run_id, r.created_at, r.expname, r.bank, r.prefix, r.feature_set, s.clf,
+                   s.auc_mean, s.auc_std, s.search_sec, r.n_merchants, r.n_features
+            FROM summary s JOIN runs r USING (run_id)
+            {where}
+            ORDER BY s.auc_mean DESC
+            LIMIT ?''', con, params=params + [top])
+    finally:
+        con.close()
+
+
+def compare(db_fname, by='feature_set', bank=None, expname=None):
+    '''
+    mean test auc of the latest run of every (by, clf) pair, e.g. feature sets x classifiers
+    '''
+    assert by in ['feature_set', 'bank', 'expname', 'prefix'], f'can not compare by {by}'
+    where, params = _where({'r.bank': bank, 'r.expname': expname})
+    con = connect(db_fname)
+    try:
+        df = pd.read_sql_query(f'''
+            SELECT r.{by}, s.clf, s.auc_mean
+            FROM summary s JOIN runs r USING (run_id)
+            JOIN (SELECT r.{by} AS key, s.clf AS clf, max(s.run_id) AS run_id
+                  FROM summary s JOIN runs r USING (run_id) {where} GROUP BY r.{by}, s.clf) latest
+              ON latest.run_id = s.run_id AND latest.clf = s.clf''', con, params=params)
+    finally:
+        con.close()
+    return df.pivot(index=by, columns='clf', values='auc_mean')
+
+
+def importances(db_fname, kind='fimp', clf=None, bank=None, feature_set=None, top=20):
+    '''
+    mean importance of every feature over the matching runs
+    '''
+    where, params = _where({'i.kind': kind, 'i.clf': clf, 'r.bank': bank, 'r.feature_set': feature_set})
+    con = connect(db_fname)
+    try:
+        return pd.read_sql_query(f'''
+            SELECT i.feature, i.clf, avg(i.mean) AS mean, avg(i.std) AS std, count(*) AS n_runs
+            FROM importances i JOIN runs r USING (run_id)
+            {where}
+            GROUP BY i.feature, i.clf
+            ORDER BY mean DESC
+            LIMIT ?''', con, params=params + [top])
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the experiment results store')
+
+    parser.add_argument(
+        '-I',
+        '--input',
+        type=str,
+        default=join('results', RESULTS_DB),
+        help='results store file name'
+    )
+
+    parser.add_argument(
+        '-Q',
+        '--query',
+        type=str,
+        choices=['leaderboard', 'compare', 'importances'],
+        default='leaderboard',
+        help='query type'
+    )
+
+    parser.add_argument(
+        '-B',
+        '--bank',
+        type=str,
+        required=False,
+        help='bank name'
+    )
+
+    parser.add_argument(
+        '-C',
+        '--clf',
+        type=str,
+        required=False,
+        help='classifier name (lr, xgboost, rf)'
+    )
+
+    parser.add_argument(
+        '-E',
+        '--expname',
+        type=str,
+        required=False,
+        help='experiment name'
+    )
+
+    parser.add_argument(
+        '-F',
+        '--feature-set',
+        type=str,
+        required=False,
+        help='feature set name (e.g. demographics+revenue) of the importance query'
+    )
+
+    parser.add_argument(
+        '-K',
+        '--kind',
+        type=str,
+        choices=['fimp', 'pimp', 'gabl'],
+        default='fimp',
+        help='importance kind'
+    )
+
+    parser.add_argument(
+        '-G',
+        '--by',
+        type=str,
+        choices=['feature_set', 'bank', 'expname', 'prefix'],
+        default='feature_set',
+        help='grouping of the comparison'
+    )
+
+    parser.add_argument(
+        '-T',
+        '--top',
+        type=int,
+        default=20,
+        help='number of rows'
+    )
+
+    args = parser.parse_args()
+    assert exists(args.input), f'{args.input} does not exist'
+
+    start = time.perf_counter()
+    if args.query == 'leaderboard':
+        df = leaderboard(args.input, bank=args.bank, clf=args.clf, expname=args.expname, top=args.top)
+    elif args.query == 'compare':
+        df = compare(args.input, by=args.by, bank=args.bank, expname=args.expname)
+    else:
+        df = importances(args.input, kind=args.kind, clf=args.clf, bank=args.bank,
+                         feature_set=args.feature_set, top=args.top)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(df.to_string())
+    print('{:.1f} ms'.format((time.perf_counter() - start) * 1000))
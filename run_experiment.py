@@ -12,7 +12,12 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.pipeline import Pipeline
+import joblib
 import logging
+import perf_log
+from importance import importance_tables
+import results_db
 
 try:
     from xgboost import XGBClassifier
@@ -29,13 +34,22 @@ warnings.filterwarnings('ignore')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-ch = logging.FileHandler('.explogfile', 'w')
+ch = logging.FileHandler('.explogfile', 'a')
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
+def feature_file_stem(feature_filepath):
+    return basename(feature_filepath).split('.')[0]
+
+
+def prefix_columns(f_df, stem):
+    f_df.columns = map(lambda x: '{}__{}'.format(stem, x), f_df.columns.tolist())
+    return f_df
+
+
 def load_data(label_filepath, feature_filepath_list):
 
     label_df = pd.read_csv(label_filepath, index_col=0)
@@ -44,9 +58,7 @@ def load_data(label_filepath, feature_filepath_list):
     feature_df_list = []
     for feature_filepath in feature_filepath_list:
         f_df = pd.read_csv(feature_filepath, index_col=0)
-        filename = basename(feature_filepath).split('.')[0]
-        f_df.columns = map(lambda x: '{}__{}'.format(filename, x), f_df.columns.tolist())
-        feature_df_list.append(f_df)
+        feature_df_list.append(prefix_columns(f_df, feature_file_stem(feature_filepath)))
     feature_df = pd.concat(feature_df_list, axis=1)
 
     label_merchantid_set = set(label_df.index.tolist())
@@ -70,52 +82,73 @@ def load_data(label_filepath, feature_filepath_list):
     return X, y, filtered_feature_df
 
 
+def build_classifiers():
+    return [('lr', GridSearchCV(
+                LogisticRegression(),
+                param_grid={"C": [0.001, 0.01, 0.1, 1.0, 10.0]},
+                scoring='roc_auc'
+            )),
+            ('xgboost', GridSearchCV(
+                XGBClassifier(objective='binary:logistic', eval_metric='auc'),
+                param_grid={'n_estimators': [10, 100],
+                            'learning_rate': [0.01, 0.05],
+                            'max_depth': [2, 5]},
+                scoring='roc_auc'
+            )),
+            ('rf', GridSearchCV(
+                RandomForestClassifier(),
+                    param_grid={'n_estimators': [10, 100],
+                                'max_depth': [3, 5, 10, 20]
+                },
+                scoring='roc_auc'
+            ))]
+
+
 def run_cross_validation(X, y, feature_df=None):
+    '''
+    outer-fold test aucs and importances of every classifier. the scaled test folds and the
+    fitted best estimators are cached for the permutation importance and group ablation.
+    '''
     test_auc_dict = {}
     fimp_dict = {}
-    for clf_name, clf in [('lr', GridSearchCV(
-                                LogisticRegression(),
-                                param_grid={"C": [0.001, 0.01, 0.1, 1.0, 10.0]},
-                                scoring='roc_auc'
-                            )),
-                            ('xgboost', GridSearchCV(
-                                XGBClassifier(objective='binary:logistic', eval_metric='auc'),
-                                param_grid={'n_estimators': [10, 100],
-                                            'learning_rate': [0.01, 0.05],
-                                            'max_depth': [2, 5]},
-                                scoring='roc_auc'
-                            )),
-                            ('rf', GridSearchCV(
-                                RandomForestClassifier(),
-                                    param_grid={'n_estimators': [10, 100],
-                                                'max_depth': [3, 5, 10, 20]
-                                },
-                                scoring='roc_auc'
-                            ))]:
+    fold_dict = {}
+    search_dict = {}
+    for clf_name, clf in build_classifiers():
         skf = StratifiedKFold(n_splits=5,
                               shuffle=True,
                               random_state=1)
         test_auc_list = []
         fimp_list = []
-        for train_index, test_index in skf.split(X, y):
+        fold_list = []
+        search_list = []
+        for fold, (train_index, test_index) in enumerate(skf.split(X, y)):
             X_train, X_test = X[train_index, :], X[test_index, :]
             y_train, y_test = y[train_index], y[test_index]
             scaler = StandardScaler()
             X_train = scaler.fit_transform(X_train)
             X_test = scaler.transform(X_test)
-            clf.fit(X_train, y_train)
+            with perf_log.stage(f'fit_{clf_name}', fold=fold) as step:
+                step.rows_in = X_train.shape[0]
+                clf.fit(X_train, y_train)
             test_auc = roc_auc_score(
                 y_test,
                 clf.best_estimator_.predict_proba(X_test)[:, 1])
             test_auc_list.append(test_auc)
+            fold_list.append((clf.best_estimator_, X_test, y_test))
+            # grid search cost: inner fits of every candidate and the refit of the best one
+            search_list.append({'search_sec': float(np.sum(clf.cv_results_['mean_fit_time']) * clf.n_splits_ + clf.refit_time_),
+                                'n_candidates': len(clf.cv_results_['params']),
+                                'best_params': clf.best_params_})
             # feature importance
             if clf_name == 'lr':
                 fimp = clf.best_estimator_.coef_[0]
-            elif clf_name == 'xgboost':
+            elif clf_name in ['xgboost', 'rf']:
                 fimp = clf.best_estimator_.feature_importances_
             fimp_list.append(fimp)
 
         test_auc_dict[clf_name] = test_auc_list
+        fold_dict[clf_name] = fold_list
+        search_dict[clf_name] = search_list
         fimp_df = pd.DataFrame(fimp_list, columns=feature_df.columns)
         fimp_dict[clf_name] = fimp_df
 
@@ -127,7 +160,37 @@ def run_cross_validation(X, y, feature_df=None):
 
     eval_df = pd.concat([test_auc_df, mean_df, std_df], axis=0)
 
-    return eval_df, fimp_dict
+    return eval_df, fimp_dict, fold_dict, search_dict
+
+
+def fit_final_models(X, y):
+    '''
+    fit the scaler and the best model of every classifier on all instances
+    '''
+    pipelines = {}
+    for clf_name, clf in build_classifiers():
+        with perf_log.stage(f'final_fit_{clf_name}') as step:
+            step.rows_in = X.shape[0]
+            scaler = StandardScaler()
+            clf.fit(scaler.fit_transform(X), y)
+            pipelines[clf_name] = (Pipeline([('scaler', scaler), ('clf', clf.best_estimator_)]), clf.best_params_)
+    return pipelines
+
+
+def save_models(pipelines, output_filepath, label_filepath, feature_filepath_list, feature_df):
+    '''
+    persist the final pipelines together with the feature column metadata needed for scoring
+    '''
+    for clf_name, (pipeline, best_params) in pipelines.items():
+        model_filepath = output_filepath.replace('.csv', '_model_{}.joblib'.format(clf_name))
+        joblib.dump({'clf_name': clf_name,
+                     'pipeline': pipeline,
+                     'best_params': best_params,
+                     'feature_stems': [feature_file_stem(f) for f in feature_filepath_list],
+                     'columns': feature_df.columns.tolist(),
+                     'label': basename(label_filepath),
+                     'trained_at': datetime.now().isoformat(timespec='seconds')}, model_filepath)
+        logger.debug('saved {} model: {}'.format(clf_name, model_filepath))
 
 
 def create_filename(label_filepath, feature_filepath_list):
@@ -136,22 +199,58 @@ def create_filename(label_filepath, feature_filepath_list):
     return '{}_{}.csv'.format(prefix, suffix)
 
 
-def run_experiment(label_filepath, feature_filepath_list, output_dirpath):
+@perf_log.stage('run_experiment')
+def run_experiment(label_filepath, feature_filepath_list, output_dirpath, persist_models=False,
+                   importance=False, n_repeats=5, n_jobs=-1, batch_cells=2**22, results_db_fname=None, expname=None):
+    perf = perf_log.current()
+    perf.meta['label'] = basename(label_filepath)
+    perf.meta['features'] = [basename(f) for f in feature_filepath_list]
     assert exists(output_dirpath), f'{output_dirpath} does not exists'
 
     output_filepath = join(output_dirpath, create_filename(label_filepath, feature_filepath_list))
     
     X, y, feature_df = load_data(label_filepath, feature_filepath_list)
+    for filepath in [label_filepath] + feature_filepath_list:
+        perf.read(filepath)
+    perf.rows_in = X.shape[0]
 
-    eval_df, fimp_dict = run_cross_validation(X, y, feature_df)
+    eval_df, fimp_dict, fold_dict, search_dict = run_cross_validation(X, y, feature_df)
     eval_df.to_csv(output_filepath)
+    perf.wrote(output_filepath)
 
+    importance_dict = {'fimp': {}, 'pimp': {}, 'gabl': {}}
     for clf_name, fimp_df in fimp_dict.items():
         cur_filepath = output_filepath.replace('.csv', '_fimp_{}.csv'.format(clf_name))
         fimp_mean_s = fimp_df.mean(axis=0)
         fimp_std_s = fimp_df.std(axis=0)
         fimp_info_df = pd.DataFrame({'fimp_mean': fimp_mean_s, 'fimp_std': fimp_std_s})
         fimp_info_df.sort_values('fimp_mean', ascending=False).to_csv(cur_filepath)
+        importance_dict['fimp'][clf_name] = fimp_info_df
+
+    if importance:
+        for clf_name, (pimp_df, gabl_df) in importance_tables(fold_dict, feature_df.columns.tolist(),
+                                                              n_repeats=n_repeats, n_jobs=n_jobs,
+                                                              batch_cells=batch_cells).items():
+            pimp_df.sort_values('pimp_mean', ascending=False).to_csv(
+                output_filepath.replace('.csv', '_pimp_{}.csv'.format(clf_name)))
+            gabl_df.sort_values('auc_drop_mean', ascending=False).to_csv(
+                output_filepath.replace('.csv', '_gabl_{}.csv'.format(clf_name)))
+            importance_dict['pimp'][clf_name] = pimp_df
+            importance_dict['gabl'][clf_name] = gabl_df[['auc_drop_mean', 'auc_drop_std']]
+
+    if results_db_fname:
+        config = {'param_grids': {clf_name: clf.param_grid for clf_name, clf in build_classifiers()},
+                  'cv': {'n_splits': 5, 'shuffle': True, 'random_state': 1},
+                  'importance': {'n_repeats': n_repeats} if importance else None,
+                  'persist_models': persist_models}
+        run_id = results_db.record_run(results_db_fname, label_filepath, feature_filepath_list,
+                                       feature_df.columns.tolist(), X.shape[0], eval_df, search_dict,
+                                       importance_dict, expname=expname, config=config)
+        logger.debug('recorded run {} in {}'.format(run_id, results_db_fname))
+        perf.wrote(results_db_fname)
+
+    if persist_models:
+        save_models(fit_final_models(X, y), output_filepath, label_filepath, feature_filepath_list, feature_df)
 
     return eval_df, fimp_info_df
 
@@ -192,6 +291,51 @@ if __name__ == '__main__':
         help='create a sub-directory for your results'
     )
 
+    parser.add_argument(
+        '-S',
+        '--save-models',
+        action='store_true',
+        help='fit the final models on all instances and save them for scoring'
+    )
+
+    parser.add_argument(
+        '-I',
+        '--importance',
+        action='store_true',
+        help='permutation importance and feature file ablation on the outer test folds'
+    )
+
+    parser.add_argument(
+        '-R',
+        '--repeats',
+        type=int,
+        default=5,
+        help='number of permutations of every feature and fold'
+    )
+
+    parser.add_argument(
+        '-J',
+        '--jobs',
+        type=int,
+        default=-1,
+        help='number of parallel importance jobs'
+    )
+
+    parser.add_argument(
+        '-C',
+        '--batch-cells',
+        type=int,
+        default=2**22,
+        help='max number of values (rows x columns) of a stacked permutation importance matrix'
+    )
+
+    parser.add_argument(
+        '-D',
+        '--no-db',
+        action='store_true',
+        help='do not record the run in the results store ({outputdir}/results.sqlite)'
+    )
+
     args = parser.parse_args()
     feature_filepath_list = sorted(args.features)
 
@@ -202,8 +346,13 @@ if __name__ == '__main__':
     if not exists(output_dirpath):
         os.mkdir(output_dirpath)
 
+    results_db_fname = None if args.no_db else join(output_dirpath, results_db.RESULTS_DB)
+
     if expname and not exists(join(output_dirpath, expname)):
         os.mkdir(join(output_dirpath, expname))
         output_dirpath = join(output_dirpath, expname)
 
-    eval_df, fimp_info_df = run_experiment(label_filepath, feature_filepath_list, output_dirpath)
\ No newline at end of file
+    eval_df, fimp_info_df = run_experiment(label_filepath, feature_filepath_list, output_dirpath,
+                                           persist_models=args.save_models, importance=args.importance,
+                                           n_repeats=args.repeats, n_jobs=args.jobs, batch_cells=args.batch_cells,
+                                           results_db_fname=results_db_fname, expname=expname)
\ No newline at end of file
@@ -0,0 +1,373 @@
+import pandas as pd
+import numpy as np
+from os.path import join, exists, dirname
+import os
+import argparse
+import json
+import time
+import threading
+from functools import reduce
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+import joblib
+import logging
+import perf_log
+from run_experiment import prefix_columns, feature_file_stem
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.FileHandler('.scorelogfile', 'a')
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+def load_models(model_filepath_list):
+    '''
+    load the persisted pipelines, all models must be trained on the same feature columns
+    '''
+    models = {}
+    for model_filepath in model_filepath_list:
+        model = joblib.load(model_filepath)
+        models[model['clf_name']] = model
+    first = next(iter(models.values()))
+    for model in models.values():
+        assert model['columns'] == first['columns'], 'models are trained on different feature columns'
+    return models
+
+
+def order_feature_files(feature_filepath_list, stems):
+    '''
+    feature files in the order of the training feature files, files are matched by name
+    and by position when the names differ (e.g. scoring another bank)
+    '''
+    assert len(feature_filepath_list) == len(stems), \
+        f'models are trained on {len(stems)} feature files: {stems}'
+    by_stem = {feature_file_stem(f): f for f in feature_filepath_list}
+    if set(by_stem) == set(stems):
+        return [by_stem[stem] for stem in stems]
+    return feature_filepath_list
+
+
+def read_features(feature_filepath_list, stems, chunksize=None):
+    '''
+    yields merchant feature chunks with the training column names.
+    the first feature file is streamed, the others are aligned to the merchants of each chunk.
+    merchants that are only in the other files come last, as in the outer concat of load_data.
+    '''
+    feature_filepath_list = order_feature_files(feature_filepath_list, stems)
+    others = [prefix_columns(pd.read_csv(f, index_col=0), stem)
+              for f, stem in zip(feature_filepath_list[1:], stems[1:])]
+    rest = reduce(pd.Index.union, [f_df.index for f_df in others], pd.Index([]))
+    chunks = pd.read_csv(feature_filepath_list[0], index_col=0, chunksize=chunksize)
+    for chunk_df in ([chunks] if chunksize is None else chunks):
+        chunk_df = prefix_columns(chunk_df, stems[0])
+        rest = rest.difference(chunk_df.index)
+        yield pd.concat([chunk_df] + [f_df.reindex(chunk_df.index) for f_df in others], axis=1)
+
+    if len(rest) > 0:
+        logger.debug('{} merchants are not in {}, their features are 0'.format(len(rest), feature_filepath_list[0]))
+        yield pd.concat([f_df.reindex(rest) for f_df in others], axis=1)
+
+
+def feature_matrix(feature_df, columns):
+    '''
+    feature matrix in the training column order, missing features are 0 as in training
+    '''
+    return feature_df.reindex(columns=columns).fillna(0).to_numpy(dtype=np.float64)
+
+
+def predict(models, X, index):
+    '''
+    well-performing probability of every merchant for every model
+    '''
+    if X.shape[0] == 0:
+        return pd.DataFrame(columns=list(models), index=index, dtype=np.float64)
+    return pd.DataFrame({clf_name: model['pipeline'].predict_proba(X)[:, 1] for clf_name, model in models.items()},
+                        index=index)
+
+
+@perf_log.stage('score_merchants')
+def score_merchants(model_filepath_list, feature_filepath_list, output_filepath, chunksize):
+    '''
+    batch scoring of the merchants in the feature files
+    '''
+    perf = perf_log.current()
+    assert not exists(output_filepath), f'{output_filepath} already exists'
+    if dirname(output_filepath):
+        os.makedirs(dirname(output_filepath), exist_ok=True)
+
+    models = load_models(model_filepath_list)
+    first = next(iter(models.values()))
+
+    header = True
+    n_rows = 0
+    for feature_df in read_features(feature_filepath_list, first['feature_stems'], chunksize):
+        score_df = predict(models, feature_matrix(feature_df, first['columns']), feature_df.index)
+        score_df.to_csv(output_filepath, header=header, mode='a')
+        header = False
+        n_rows += score_df.shape[0]
+
+    logger.debug('scored {} merchants with {} models, features: {}, output: {}'.format(
+        n_rows, list(models), feature_filepath_list, output_filepath))
+
+    for filepath in model_filepath_list + feature_filepath_list:
+        perf.read(filepath)
+    perf.wrote(output_filepath)
+    perf.rows_out = n_rows
+
+
+class ScoringModel:
+    '''
+    warm models and a merchant-indexed feature matrix for per-merchant scoring
+    '''
+    def __init__(self, models, feature_df):
+        self.models = models
+        self.columns = next(iter(models.values()))['columns']
+        self.index = pd.Index(feature_df.index)
+        self.X = feature_matrix(feature_df, self.columns)
+
+    def score_merchants(self, merchant_ids):
+        merchant_ids = list(dict.fromkeys(merchant_ids))
+        pos = self.index.get_indexer(merchant_ids)
+        known = pos >= 0
+        scores = predict(self.models, self.X[pos[known]], self.index[pos[known]])
+        return scores, [m for m, k in zip(merchant_ids, known) if not k]
+
+    def check_records(self, records, partial=False):
+        '''
+        (missing, unknown) feature columns of the records, columns are the training names
+        ({file stem}__{column}). missing columns are allowed in partial records and are 0.
+        '''
+        keys = set().union(*records) if records else set()
+        unknown = sorted(keys.difference(self.columns))
+        missing = [] if partial else [col for col in self.columns
+                                      if any(record.get(col) is None for record in records)]
+        return missing, unknown
+
+    def score_records(self, records):
+        feature_df = pd.DataFrame.from_records(records)
+        return predict(self.models, feature_matrix(feature_df, self.columns), feature_df.index)
+
+
+def make_handler(scorer):
+
+    class ScoreHandler(BaseHTTPRequestHandler):
+        '''
+        GET /score?merchant_id=1,2 scores merchants of the feature table,
+        POST /score with {"merchant_id": [...]} or {"records": [{column: value}]} scores
+        merchants by id or by raw feature values. records use the training column names and
+        need all of them unless {"partial": true} is given.
+        '''
+        def _reply(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _reply_scores(self, scores, unknown=()):
+            self._reply(200, {'scores': {str(k): v for k, v in scores.to_dict(orient='index').items()},
+                              'unknown': [str(m) for m in unknown]})
+
+        def _merchant_ids(self, values):
+            '''
+            merchant ids of the request in the dtype of the feature table, None if invalid
+            '''
+            if not isinstance(values, list) or any(isinstance(m, (bool, list, dict)) or m is None for m in values):
+                return None
+            try:
+                merchant_ids = [scorer.index.dtype.type(m) for m in values]
+            except (TypeError, ValueError):
+                return None
+            # 106618.7 is not merchant 106618
+            if scorer.index.dtype.kind in 'iu' and any(isinstance(m, float) and not m.is_integer() for m in values):
+                return None
+            return merchant_ids
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                return self._reply(200, {'models': list(scorer.models), 'merchants': len(scorer.index)})
+            if url.path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            merchant_ids = self._merchant_ids([m for v in parse_qs(url.query).get('merchant_id', [])
+                                               for m in v.split(',') if m])
+            if merchant_ids is None:
+                return self._reply(400, {'error': 'invalid merchant id'})
+            self._reply_scores(*scorer.score_merchants(merchant_ids))
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                return self._reply(400, {'error': 'invalid json'})
+            if not isinstance(body, dict):
+                return self._reply(400, {'error': 'body should be a json object'})
+            if 'records' in body:
+                records = body['records']
+                if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+                    return self._reply(400, {'error': 'records should be a list of objects'})
+                missing, unknown = scorer.check_records(records, partial=body.get('partial') is True)
+                if missing or unknown:
+                    return self._reply(400, {'error': 'records should use the training feature columns',
+                                             'missing': missing, 'unknown': unknown})
+                try:
+                    return self._reply_scores(scorer.score_records(records))
+                except (TypeError, ValueError):
+                    return self._reply(400, {'error': 'invalid feature values'})
+            merchant_ids = self._merchant_ids(body.get('merchant_id', []))
+            if merchant_ids is None:
+                return self._reply(400, {'error': 'merchant_id should be a list of merchant ids'})
+            self._reply_scores(*scorer.score_merchants(merchant_ids))
+
+        def log_message(self, format, *args):
+            logger.debug('{} {}'.format(self.address_string(), format % args))
+
+    return ScoreHandler
+
+
+def load_scorer(model_filepath_list, feature_filepath_list):
+    models = load_models(model_filepath_list)
+    feature_df = pd.concat(list(read_features(feature_filepath_list, next(iter(models.values()))['feature_stems'])))
+    return ScoringModel(models, feature_df)
+
+
+def serve(scorer, port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(scorer))
+    print(f'serving {list(scorer.models)} for {len(scorer.index)} merchants on http://127.0.0.1:{server.server_port}/score')
+    logger.debug('serving models {} on port {}'.format(list(scorer.models), server.server_port))
+    server.serve_forever()
+
+
+def latency_summary(latencies):
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': np.percentile(latencies, 50),
+            'p95_ms': np.percentile(latencies, 95),
+            'p99_ms': np.percentile(latencies, 99)}
+
+
+@perf_log.stage('benchmark_scoring')
+def benchmark(scorer, batch_sizes, n_requests):
+    '''
+    batch throughput, in-process single merchant latency and http round-trip latency
+    '''
+    rng = np.random.default_rng(1)
+    rows = []
+
+    for batch_size in batch_sizes:
+        idx = rng.integers(len(scorer.index), size=batch_size)
+        start = time.perf_counter()
+        predict(scorer.models, scorer.X[idx], scorer.index[idx])
+        elapsed = time.perf_counter() - start
+        rows.append({'benchmark': f'batch_{batch_size}', 'rows_per_sec': batch_size / elapsed})
+
+    merchant_ids = scorer.index[rng.integers(len(scorer.index), size=n_requests)]
+    latencies = []
+    for merchant_id in merchant_ids:
+        start = time.perf_counter()
+        scorer.score_merchants([merchant_id])
+        latencies.append(time.perf_counter() - start)
+    rows.append({'benchmark': 'single_merchant', **latency_summary(latencies)})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(scorer))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/score?merchant_id='
+    latencies = []
+    for merchant_id in merchant_ids:
+        start = time.perf_counter()
+        with urlopen(f'{url}{merchant_id}') as response:
+            response.read()
+        latencies.append(time.perf_counter() - start)
+    server.shutdown()
+    rows.append({'benchmark': 'http_single_merchant', **latency_summary(latencies)})
+
+    bench_df = pd.DataFrame(rows).set_index('benchmark')
+    logger.debug('benchmark, models: {}, merchants: {}\n{}'.format(
+        list(scorer.models), len(scorer.index), bench_df.to_string()))
+    return bench_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score merchants with the models saved by run_experiment.py')
+
+    parser.add_argument(
+        '-M',
+        '--models',
+        nargs='*',
+        type=str,
+        required=True,
+        help='model file names (*_model_{clf}.joblib)'
+    )
+
+    parser.add_argument(
+        '-F',
+        '--features',
+        nargs='*',
+        type=str,
+        required=True,
+        help='feature file names, in the order of the training feature files'
+    )
+
+    parser.add_argument(
+        '-O',
+        '--output',
+        type=str,
+        default=join('eval', 'scores.csv'),
+        help='output score file name'
+    )
+
+    parser.add_argument(
+        '-C',
+        '--chunksize',
+        type=int,
+        default=100000,
+        help='number of merchants scored at once'
+    )
+
+    parser.add_argument(
+        '-S',
+        '--serve',
+        action='store_true',
+        help='serve the warm models over http instead of batch scoring'
+    )
+
+    parser.add_argument(
+        '-p',
+        '--port',
+        type=int,
+        default=8080,
+        help='http port'
+    )
+
+    parser.add_argument(
+        '-b',
+        '--benchmark',
+        action='store_true',
+        help='run the throughput and latency benchmarks'
+    )
+
+    parser.add_argument(
+        '-N',
+        '--requests',
+        type=int,
+        default=1000,
+        help='number of single merchant requests in the latency benchmark'
+    )
+
+    args = parser.parse_args()
+    feature_filepath_list = args.features
+
+    if args.benchmark:
+        scorer = load_scorer(args.models, feature_filepath_list)
+        print(benchmark(scorer, sorted({1, 100, 10000, args.chunksize}), args.requests).to_string())
+    elif args.serve:
+        serve(load_scorer(args.models, feature_filepath_list), args.port)
+    else:
+        score_merchants(args.models, feature_filepath_list, args.output, args.chunksize)
@@ -5,22 +5,27 @@ from os.path import join, exists
 import os
 import yaml
 import logging
+import perf_log
 
 import warnings
 warnings.filterwarnings('ignore')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-ch = logging.FileHandler('.spatialfiltlog', 'w')
+ch = logging.FileHandler('.spatialfiltlog', 'a')
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s ~~ %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+@perf_log.stage('geo_filter_merchants')
 def geo_filter_merchants(trans_fname, bank, geom, config, overwrite=False):
     '''
     filter merchants by their locations
     '''
+    perf = perf_log.current()
+    perf.meta['bank'] = bank
+
     output_file = join('data', f'bank_{bank}_transactions.csv')
     if exists(output_file):
         if not overwrite:
@@ -54,6 +59,11 @@ def geo_filter_merchants(trans_fname, bank, geom, config, overwrite=False):
         df.drop(['geometry', 'index_right'], axis=1).to_csv(output_file, header=header, index=False, mode='a')
         header=False
 
+    perf.read(trans_fname)
+    perf.wrote(output_file)
+    perf.rows_in = original_trans
+    perf.rows_out = n_trans
+
     logger.debug('bank {} -> original # of transactions: {}'.format(bank, original_trans))
     logger.debug('bank {} -> original # of merchants: {}'.format(bank, original_num_merchants))
 